@@ -264,4 +264,60 @@ CELERYD_HIJACK_ROOT_LOGGER = False
 
 CELERYBEAT_SCHEDULER = "djcelery.schedulers.DatabaseScheduler"
 
+# Number of concurrent XML-RPC calls made while fetching a single package
+PYPI_FETCH_CONCURRENCY = 10
+
+# Number of XML-RPC calls packed into a single system.multicall request
+PYPI_MULTICALL_BATCH_SIZE = 50
+
+# Shared keep-alive pool used for every upstream HTTP and XML-RPC request
+PYPI_HTTP_POOL_CONNECTIONS = 10
+PYPI_HTTP_POOL_SIZE = 10
+PYPI_HTTP_TIMEOUT = 30
+
+# Size of the chunks distribution files are streamed to disk in while mirroring
+PYPI_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Mirror distribution files into package storage after every sync. The
+# downloads run as mirror_file tasks on the "mirror" queue, which needs its
+# own workers (celeryd -Q mirror --concurrency=PYPI_MIRROR_CONCURRENCY),
+# limited to PYPI_MIRROR_CONCURRENCY downloads and PYPI_MIRROR_BANDWIDTH
+# bytes per second (0 is unlimited) between them. Tasks beyond the limit
+# wait in their worker for a free slot.
+PYPI_MIRROR_FILES = False
+PYPI_MIRROR_CONCURRENCY = 4
+PYPI_MIRROR_BANDWIDTH = 0
+PYPI_MIRROR_MAX_ATTEMPTS = 5
+
+CELERY_ROUTES = {
+    "crate.pypi.tasks.mirror_file": {"queue": "mirror"},
+}
+
+# Fetch files that have not been mirrored yet from upstream the first time
+# they are requested, storing them while they are streamed to the client
+PYPI_PULL_THROUGH = False
+
+# Have the front end proxy serve locally stored files, either
+# "x-accel-redirect" (nginx, with an internal location at
+# PYPI_FILE_ACCEL_PREFIX aliased to the package storage root) or
+# "x-sendfile" (Apache mod_xsendfile, lighttpd). None redirects to the
+# storage url instead.
+PYPI_FILE_SENDFILE = None
+PYPI_FILE_ACCEL_PREFIX = "/internal/packages/"
+
+# Poll interval bounds, in seconds, for the consume_changelog command
+PYPI_CONSUMER_MIN_INTERVAL = 1
+PYPI_CONSUMER_MAX_INTERVAL = 30
+
+# Number of packages each bulk_process_chunk task processes during a bulk sync
+PYPI_BULK_CHUNK_SIZE = 500
+
+# Seconds after which a resumed bulk sync queues a chunk that has still not
+# finished again, assuming the task was lost
+PYPI_BULK_CHUNK_TIMEOUT = 60 * 60 * 6
+
+# Where PyPIPackage.fetch gets its meta data from, either
+# crate.pypi.processor.XMLRPCSource or crate.pypi.processor.JSONSource
+PYPI_UPSTREAM_SOURCE = "crate.pypi.processor.XMLRPCSource"
+
 ADMIN_TOOLS_INDEX_DASHBOARD = "crate.web.dashboard.CrateIndexDashboard"
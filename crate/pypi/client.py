@@ -0,0 +1,115 @@
+"""
+Shared upstream clients for talking to PyPI and the PyPI datastore.
+
+Everything in here is created once per worker process and reused by every
+task that runs in it, so consecutive tasks reuse the keep-alive connections
+instead of paying for a new TCP connection (and DNS lookup) each time.
+"""
+import threading
+import xmlrpclib
+
+import redis
+import requests
+
+from django.conf import settings
+
+INDEX_URL = "http://pypi.python.org/pypi"
+
+_lock = threading.Lock()
+_session = None
+_datastores = {}
+
+
+class SessionTransport(xmlrpclib.Transport):
+    """
+        XML-RPC transport that sends requests through the shared requests
+        session so that XML-RPC calls come out of the same keep-alive pool
+        as every other upstream request. Unlike the stock transport it does
+        not hold on to a connection itself, which makes it safe to share a
+        ServerProxy between threads.
+    """
+
+    def __init__(self, use_datetime=0, scheme="http"):
+        xmlrpclib.Transport.__init__(self, use_datetime=use_datetime)
+        self.scheme = scheme
+
+    def request(self, host, handler, request_body, verbose=0):
+        url = "%s://%s%s" % (self.scheme, host, handler)
+        headers = {"Content-Type": "text/xml", "User-Agent": self.user_agent}
+
+        resp = get_session().post(url, data=request_body, headers=headers, prefetch=True)
+
+        if resp.status_code != 200:
+            raise xmlrpclib.ProtocolError(host + handler, resp.status_code, resp.reason, resp.headers)
+
+        parser, unmarshaller = self.getparser()
+        parser.feed(resp.content)
+        parser.close()
+
+        return unmarshaller.close()
+
+
+def get_session():
+    global _session
+
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = requests.session(
+                    timeout=getattr(settings, "PYPI_HTTP_TIMEOUT", 30),
+                    config={
+                        "keep_alive": True,
+                        "pool_connections": getattr(settings, "PYPI_HTTP_POOL_CONNECTIONS", 10),
+                        "pool_maxsize": getattr(settings, "PYPI_HTTP_POOL_SIZE", 10),
+                    },
+                )
+    return _session
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def get_index_url():
+    return getattr(settings, "PYPI_INDEX_URL", INDEX_URL)
+
+
+def get_pypi(url=None):
+    if url is None:
+        url = get_index_url()
+
+    scheme = url.split(":", 1)[0]
+    return xmlrpclib.ServerProxy(url, transport=SessionTransport(use_datetime=True, scheme=scheme))
+
+
+def get_datastore(name=None):
+    if name is None:
+        name = settings.PYPI_DATASTORE
+
+    if name not in _datastores:
+        with _lock:
+            if name not in _datastores:
+                _datastores[name] = redis.StrictRedis(**dict([(x.lower(), y) for x, y in settings.REDIS[name].items()]))
+    return _datastores[name]
+
+
+def stats():
+    """
+        Returns the connection reuse counters for the shared HTTP pool. A
+        request that did not need a new connection counts as reused.
+    """
+    requests_made = 0
+    connections = 0
+
+    pools = get_session().poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            requests_made += pool.num_requests
+            connections += pool.num_connections
+
+    return {
+        "requests": requests_made,
+        "connections": connections,
+        "reused": max(requests_made - connections, 0),
+    }
@@ -2,3 +2,9 @@ class PackageHashMismatch(Exception):
     """
         The provided hash did not match what we downloaded.
     """
+
+
+class ReleaseFetchError(Exception):
+    """
+        Fetching the data for a specific release from PyPI failed.
+    """
@@ -0,0 +1,103 @@
+import logging
+import signal
+import time
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from crate.pypi import client
+from crate.pypi.tasks import PYPI_SINCE_KEY, dispatch_changes, get_start_serial
+from crate.pypi.utils.lock import Lock
+
+logger = logging.getLogger(__name__)
+
+PYPI_CONSUMER_KEY = "crate:pypi:consumer"
+
+
+class Command(BaseCommand):
+
+    help = "Follows the PyPI changelog, queueing processing for changes as soon as they appear."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--min-interval", type="float", dest="min_interval",
+                    default=getattr(settings, "PYPI_CONSUMER_MIN_INTERVAL", 1),
+                    help="Seconds between polls while there are changes coming in."),
+        make_option("--max-interval", type="float", dest="max_interval",
+                    default=getattr(settings, "PYPI_CONSUMER_MAX_INTERVAL", 30),
+                    help="Most seconds between polls when the changelog is idle."),
+    )
+
+    def handle(self, *args, **options):
+        self.running = True
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        datastore = client.get_datastore()
+        pypi = client.get_pypi()
+
+        if get_start_serial(pypi, datastore) is None:
+            raise CommandError("There is no changelog serial to follow yet, run the synchronize task for the initial bulk sync first.")
+
+        interval = options["min_interval"]
+
+        while self.running:
+            # Shares the lock with the synchronize task so only one of them follows the changelog at a time
+            lock = Lock("synchronize", expires=60 * 5)
+
+            changes = None
+
+            if lock.acquire(blocking=False):
+                try:
+                    changes = self.poll(pypi, datastore)
+                except Exception:
+                    logger.exception("[CONSUMER] poll failed")
+                finally:
+                    lock.release()
+
+            # Poll again straight away while busy, back off while idle
+            if changes:
+                interval = options["min_interval"]
+            else:
+                interval = min(interval * 2, options["max_interval"])
+
+            self.sleep(interval)
+
+        logger.info("[CONSUMER] stopped")
+
+    def poll(self, pypi, datastore):
+        serial = get_start_serial(pypi, datastore)
+        changes = dispatch_changes(pypi, datastore, serial)
+
+        polled = time.time()
+        datastore.set(PYPI_SINCE_KEY, int(polled))
+
+        if changes:
+            serial = max([change[4] for change in changes])
+
+        metrics = {
+            "serial": serial,
+            # Journal entries upstream that we have not dispatched yet
+            "serial_lag": max(pypi.changelog_last_serial() - serial, 0),
+            # Seconds between the newest change happening upstream and us dispatching it
+            "latency": max(polled - max([change[2] for change in changes]), 0) if changes else 0,
+            "polled": polled,
+        }
+        datastore.hmset(PYPI_CONSUMER_KEY, metrics)
+
+        if changes or metrics["serial_lag"]:
+            logger.info("[CONSUMER] serial %(serial)s, %(serial_lag)s behind, %(latency).1fs latency" % metrics)
+
+        return changes
+
+    def sleep(self, seconds):
+        # Sleep in small steps so a SIGTERM is acted on promptly
+        until = time.time() + seconds
+        while self.running and time.time() < until:
+            time.sleep(max(min(0.5, until - time.time()), 0))
+
+    def stop(self, signum, frame):
+        logger.info("[CONSUMER] stopping after the current poll")
+        self.running = False
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from crate.pypi import client
+from crate.pypi.tasks import reconcile_packages
+
+
+class Command(BaseCommand):
+
+    help = "Deletes local packages that no longer exist on PyPI."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+                    help="Only report the packages that are gone upstream, do not delete them."),
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+                    help="Number of local packages to compare and delete at a time."),
+    )
+
+    def handle(self, *args, **options):
+        names = client.get_pypi().list_packages()
+
+        drifted = reconcile_packages(names, batch_size=options["batch_size"], dry_run=options["dry_run"])
+
+        for normalized_name in drifted:
+            self.stdout.write("%s\n" % normalized_name)
+
+        self.stdout.write("%s packages %s\n" % (len(drifted), "are gone upstream" if options["dry_run"] else "deleted"))
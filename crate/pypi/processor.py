@@ -1,35 +1,48 @@
 import base64
+import collections
+import datetime
 import hashlib
+import json
 import logging
 import re
+import tempfile
 import urllib
 import urlparse
 import xmlrpclib
 
-import redis
+from multiprocessing.pool import ThreadPool
+
 import requests
 import lxml.html
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.core.files.base import ContentFile
+from django.core.files import File
 from django.db import transaction
-from django.utils.timezone import utc
+from django.utils.importlib import import_module
+from django.utils.timezone import now, utc
 
 from crate.web.history.models import Event
-from crate.web.packages.models import Package, Release, TroveClassifier
+from crate.web.packages.models import Package, Release
+from crate.web.packages.models import deferred_link_extraction, suspended_version_ordering, update_version_ordering
 from crate.web.packages.models import ReleaseRequire, ReleaseProvide, ReleaseObsolete, ReleaseURI, ReleaseFile
-from crate.pypi.exceptions import PackageHashMismatch
+from crate.pypi import client
+from crate.pypi.exceptions import PackageHashMismatch, ReleaseFetchError
 from crate.pypi.models import PyPIMirrorPage
+from crate.pypi.utils import troves
+from crate.pypi.utils.delete import delete_packages
+from crate.pypi.utils.lock import Lock
 
 logger = logging.getLogger(__name__)
 
-INDEX_URL = "http://pypi.python.org/pypi"
 SIMPLE_URL = "http://pypi.python.org/simple/"
 
 _disutils2_version_capture = re.compile("^(.*?)(?:\(([^()]+)\))?$")
 _md5_re = re.compile(r"(https?://pypi\.python\.org/packages/.+)#md5=([a-f0-9]+)")
 
+# Flipped off for the life of the worker once PyPI rejects system.multicall
+_multicall_supported = True
+
 
 def get_helper(data, key, default=None):
     if data.get(key) and data[key] != "UNKNOWN":
@@ -49,6 +62,407 @@ def split_meta(meta):
     }
 
 
+def fingerprint(data):
+    """
+        Returns a stable hash of the built data for a release. File download
+        counts are left out, they change constantly and are kept up to date
+        by synchronize_downloads instead.
+    """
+    data = dict(data)
+    data["files"] = [dict([(k, v) for k, v in f.items() if k != "downloads"]) for f in data.get("files", [])]
+
+    def canonical(value):
+        if isinstance(value, dict):
+            return dict([(k, canonical(v)) for k, v in value.items()])
+        elif isinstance(value, (list, tuple)):
+            return sorted([canonical(v) for v in value], key=lambda x: json.dumps(x, sort_keys=True))
+        elif isinstance(value, datetime.datetime):
+            return value.isoformat()
+        return value
+
+    return hashlib.sha256(json.dumps(canonical(data), sort_keys=True)).hexdigest()
+
+
+def pool_map(func, items):
+    """
+        Maps ``func`` over ``items`` using a pool of at most
+        PYPI_FETCH_CONCURRENCY threads.
+    """
+    concurrency = min(getattr(settings, "PYPI_FETCH_CONCURRENCY", 1), len(items))
+
+    if concurrency <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.terminate()
+
+
+def stream_to_file(resp, callback=None):
+    """
+        Writes the body of a streamed response to an anonymous temporary
+        file in PYPI_DOWNLOAD_CHUNK_SIZE chunks, computing the md5 and
+        sha256 of the content in the same pass. Returns a File wrapping
+        the temporary file along with both hexdigests.
+
+        If given, ``callback`` is called with the size of every chunk.
+    """
+    chunk_size = getattr(settings, "PYPI_DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+
+    fp = tempfile.TemporaryFile()
+
+    try:
+        for chunk in resp.iter_content(chunk_size):
+            md5.update(chunk)
+            sha256.update(chunk)
+            fp.write(chunk)
+            size += len(chunk)
+
+            if callback is not None:
+                callback(len(chunk))
+        fp.seek(0)
+    except Exception:
+        fp.close()
+        raise
+
+    content = File(fp)
+    content.size = size
+
+    return content, md5.hexdigest().lower(), sha256.hexdigest().lower()
+
+
+def save_release_file(release_file, content, sha256_hash):
+    """
+        Stores downloaded ``content`` for ``release_file`` and records the
+        file_add event for it.
+    """
+    release_file.digest = "$".join(["sha256", sha256_hash])
+
+    release_file.full_clean()
+    release_file.save_content(content)
+    release_file.save()
+
+    Event.objects.create(
+        package=release_file.release.package.name,
+        version=release_file.release.version,
+        action=Event.ACTIONS.file_add,
+        data={
+            "filename": release_file.filename,
+            "digest": release_file.digest,
+            "uri": release_file.get_absolute_url(),
+        }
+    )
+
+
+def download_release_file(release_file, file_data, datastore, skip_modified=True, callback=None):
+    """
+        Mirrors a single distribution file from PyPI into package storage.
+        Returns False if PyPI says the file has not been modified since we
+        last downloaded it.
+    """
+    datastore_key = "crate:pypi:download:%(url)s" % {"url": file_data["file"]}
+    stored_file_data = datastore.hgetall(datastore_key)
+
+    expected_md5 = file_data["digests"]["md5"].lower()
+
+    headers = None
+
+    if stored_file_data and skip_modified:
+        # Stored data exists for this file, check we still have the file
+        # itself without reading it back out of storage
+        if release_file.file and release_file.file.storage.exists(release_file.file.name):
+            if stored_file_data.get("md5", "").lower() == expected_md5:
+                # The supposed MD5 from PyPI matches our local
+                if not stored_file_data.get("modified"):
+                    logger.info("[DOWNLOAD] skipping %(filename)s because we already have it" % {"filename": release_file.filename})
+                    return False
+
+                headers = {
+                    "If-Modified-Since": stored_file_data["modified"],
+                }
+
+    resp = client.get(file_data["file"], headers=headers, prefetch=False)
+
+    if resp.status_code == 304:
+        logger.info("[DOWNLOAD] skipping %(filename)s because it has not been modified" % {"filename": release_file.filename})
+        return False
+    logger.info("[DOWNLOAD] downloading %(filename)s" % {"filename": release_file.filename})
+
+    resp.raise_for_status()
+
+    content, md5_hash, sha256_hash = stream_to_file(resp, callback=callback)
+
+    try:
+        # Make sure the MD5 of the file we receive matched what we were told it is
+        if md5_hash != expected_md5:
+            raise PackageHashMismatch("%s does not match %s for %s %s" % (
+                                                md5_hash,
+                                                expected_md5,
+                                                file_data["type"],
+                                                file_data["filename"],
+                                            ))
+
+        save_release_file(release_file, content, sha256_hash)
+    finally:
+        content.close()
+
+    record_download(datastore, file_data["file"], expected_md5, resp.headers.get("Last-Modified"))
+
+    return True
+
+
+def record_download(datastore, url, md5_hash, last_modified=None):
+    """
+        Stores data relating to a mirrored file (if modified etc) in its
+        crate:pypi:download:<url> hash. The md5 is what tells mirror() we
+        already have the file, so it is kept even without a Last-Modified.
+    """
+    datastore_key = "crate:pypi:download:%(url)s" % {"url": url}
+
+    if last_modified:
+        datastore.hmset(datastore_key, {
+            "md5": md5_hash,
+            "modified": last_modified,
+        })
+    else:
+        datastore.hset(datastore_key, "md5", md5_hash)
+        datastore.hdel(datastore_key, "modified")
+
+    # Set a year expire on the key so that stale entries disappear
+    datastore.expire(datastore_key, 31556926)
+
+
+def get_release_file_lock(release_file):
+    """
+        The lock held by whoever is downloading ``release_file`` into
+        storage, be it a mirror task or a pull through request.
+    """
+    return Lock("crate:pypi:mirror:%s" % release_file.pk, expires=60 * 60)
+
+
+def get_upstream_md5(release_file):
+    """
+        Looks up the md5 PyPI publishes for ``release_file``, returns None if
+        it can not be found.
+    """
+    try:
+        urls = client.get_pypi().release_urls(release_file.release.package.name, release_file.release.version)
+    except (xmlrpclib.Error, requests.RequestException):
+        logger.exception("[DOWNLOAD] could not look up the md5 of %s" % release_file.filename)
+        return None
+
+    for url_data in urls:
+        if url_data.get("filename") == release_file.filename and url_data.get("md5_digest"):
+            return url_data["md5_digest"].lower()
+
+    return None
+
+
+def get_upstream_source():
+    path = getattr(settings, "PYPI_UPSTREAM_SOURCE", "crate.pypi.processor.XMLRPCSource")
+    mod_name, source_name = path.rsplit(".", 1)
+    return getattr(import_module(mod_name), source_name)
+
+
+class UpstreamSource(object):
+    """
+        Fetches the meta data for a package (or a single release of it) from
+        PyPI. ``fetch`` returns ``(releases, release_data, release_url_data)``
+        with the data for each release in the shape the XML-RPC
+        ``release_data`` and ``release_urls`` calls return it, which is what
+        ``PyPIPackage.build`` expects.
+    """
+
+    def __init__(self, name, version=None):
+        self.name = name
+        self.version = version
+
+    def fetch(self):
+        raise NotImplementedError
+
+
+class XMLRPCSource(UpstreamSource):
+    """
+        Uses ``package_releases`` followed by ``release_data`` and
+        ``release_urls`` for every release.
+    """
+
+    def __init__(self, name, version=None):
+        super(XMLRPCSource, self).__init__(name, version)
+        self.pypi = client.get_pypi()
+
+    def fetch(self):
+        self.releases = self.get_releases()
+        release_data, release_url_data = self.get_release_metadata()
+        return self.releases, release_data, release_url_data
+
+    def get_releases(self):
+        if self.version is None:
+            releases = self.pypi.package_releases(self.name, True)
+        else:
+            releases = [self.version]
+
+        logger.debug("[RELEASES] %s%s [%s]" % (self.name, " %s" % self.version if self.version else "", ", ".join(releases)))
+
+        return releases
+
+    def get_release_metadata(self):
+        calls = [(method, release) for release in self.releases for method in ["release_data", "release_urls"]]
+
+        release_data = {}
+        release_url_data = {}
+
+        for (method, release), data in zip(calls, self.fetch_calls(calls)):
+            if method == "release_data":
+                logger.debug("[RELEASE DATA] %s %s" % (self.name, release))
+                release_data[release] = data
+            else:
+                logger.info("[RELEASE URL] %s %s" % (self.name, release))
+                logger.debug("[RELEASE URL DATA] %s %s %s" % (self.name, release, data))
+                release_url_data[release] = data
+
+        return release_data, release_url_data
+
+    def fetch_calls(self, calls):
+        """
+            Runs each ``(method, release)`` XML-RPC call against PyPI and returns
+            the results in the same order. Calls are packed into system.multicall
+            batches of PYPI_MULTICALL_BATCH_SIZE and the batches are spread over
+            the fetch pool.
+        """
+        batch_size = max(getattr(settings, "PYPI_MULTICALL_BATCH_SIZE", 1), 1)
+        batches = [calls[i:i + batch_size] for i in xrange(0, len(calls), batch_size)]
+
+        def fetch_batch(batch):
+            global _multicall_supported
+
+            if len(batch) > 1 and _multicall_supported:
+                try:
+                    return self.multicall(batch)
+                except xmlrpclib.Fault as e:
+                    logger.warning("[MULTICALL] Rejected by PyPI, falling back to single calls: %s" % e)
+                    _multicall_supported = False
+
+            return [self.call(method, release) for method, release in batch]
+
+        return [data for batch in pool_map(fetch_batch, batches) for data in batch]
+
+    def call(self, method, release):
+        try:
+            return getattr(self.pypi, method)(self.name, release)
+        except Exception as e:
+            logger.exception("[FETCH ERROR] %s %s" % (self.name, release))
+            raise ReleaseFetchError("%s %s could not be fetched: %r" % (self.name, release, e))
+
+    def multicall(self, batch):
+        multicall = xmlrpclib.MultiCall(self.pypi)
+        for method, release in batch:
+            getattr(multicall, method)(self.name, release)
+
+        try:
+            results = multicall()
+        except xmlrpclib.Fault:
+            # The multicall itself was refused, let the caller fall back
+            raise
+        except Exception as e:
+            releases = ", ".join(sorted(set([release for method, release in batch])))
+            logger.exception("[FETCH ERROR] %s %s" % (self.name, releases))
+            raise ReleaseFetchError("%s %s could not be fetched: %r" % (self.name, releases, e))
+
+        data = []
+        for i, (method, release) in enumerate(batch):
+            try:
+                data.append(results[i])
+            except xmlrpclib.Fault as e:
+                logger.error("[FETCH ERROR] %s %s %s: %s" % (self.name, release, method, e))
+                raise ReleaseFetchError("%s %s could not be fetched: %r" % (self.name, release, e))
+        return data
+
+
+class JSONSource(UpstreamSource):
+    """
+        Uses the per package JSON documents. The package document carries the
+        files for every release but only the meta data of the latest one, so
+        the remaining releases are filled in from their own documents.
+    """
+
+    def fetch(self):
+        if self.version is None:
+            document = self.get_document(self.name)
+
+            if document is None:
+                return [], {}, {}
+
+            releases = document["releases"].keys()
+
+            documents = {document["info"]["version"]: document}
+            documents.update(self.get_release_documents([x for x in releases if x not in documents]))
+        else:
+            releases = [self.version]
+            documents = self.get_release_documents(releases)
+
+        release_data = {}
+        release_url_data = {}
+
+        for release in releases:
+            document = documents.get(release) or {"info": {}, "urls": []}
+
+            release_data[release] = self.get_release_data(document["info"])
+            logger.debug("[RELEASE DATA] %s %s" % (self.name, release))
+
+            release_url_data[release] = [self.get_release_url(x) for x in document["urls"]]
+            logger.info("[RELEASE URL] %s %s" % (self.name, release))
+            logger.debug("[RELEASE URL DATA] %s %s %s" % (self.name, release, release_url_data[release]))
+
+        logger.debug("[RELEASES] %s%s [%s]" % (self.name, " %s" % self.version if self.version else "", ", ".join(releases)))
+
+        return releases, release_data, release_url_data
+
+    def get_document(self, *path):
+        url = "/".join([client.get_index_url().rstrip("/")] + [urllib.quote(x.encode("utf-8")) for x in path] + ["json"])
+
+        resp = client.get(url, prefetch=True)
+
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+
+        return json.loads(resp.content)
+
+    def get_release_documents(self, releases):
+        def get_release_document(release):
+            try:
+                return release, self.get_document(self.name, release)
+            except Exception as e:
+                logger.exception("[FETCH ERROR] %s %s" % (self.name, release))
+                raise ReleaseFetchError("%s %s could not be fetched: %r" % (self.name, release, e))
+
+        return dict(pool_map(get_release_document, releases))
+
+    def get_release_data(self, info):
+        data = dict(info)
+
+        # The JSON API has the project urls as a dict rather than "label, url" strings
+        if not data.get("project_url") and data.get("project_urls"):
+            data["project_url"] = [", ".join([label, url]) for label, url in data["project_urls"].items()]
+
+        return data
+
+    def get_release_url(self, url_data):
+        data = dict(url_data)
+
+        if data.get("upload_time"):
+            data["upload_time"] = datetime.datetime.strptime(data["upload_time"][:19], "%Y-%m-%dT%H:%M:%S")
+
+        return data
+
+
 class PyPIPackage(object):
 
     def __init__(self, name, version=None):
@@ -57,8 +471,7 @@ class PyPIPackage(object):
 
         self.stored = False
 
-        self.pypi = xmlrpclib.ServerProxy(INDEX_URL, use_datetime=True)
-        self.datastore = redis.StrictRedis(**dict([(x.lower(), y) for x, y in settings.REDIS[settings.PYPI_DATASTORE].items()]))
+        self.datastore = client.get_datastore()
 
     def process(self, bulk=False, download=True, skip_modified=True):
         self.bulk = bulk
@@ -67,12 +480,14 @@ class PyPIPackage(object):
         self.fetch()
         self.build()
 
-        with transaction.commit_on_success():
-            self.store()
+        # Link extraction reads the stored releases, so queue it once they are committed
+        with deferred_link_extraction():
+            with transaction.commit_on_success():
+                self.store()
 
-            # do not download package files
-            #if download:
-            #    self.download()
+        # Files are mirrored by their own tasks, once the release files are committed
+        if download and getattr(settings, "PYPI_MIRROR_FILES", False):
+            self.mirror()
 
     def delete(self):
         with transaction.commit_on_success():
@@ -80,11 +495,7 @@ class PyPIPackage(object):
 
             if self.version is None:
                 # Delete the entire package
-                packages = Package.objects.filter(name=self.name).select_for_update()
-                releases = Release.objects.filter(package__in=packages).select_for_update()
-
-                for package in packages:
-                    package.delete()
+                delete_packages(list(Package.objects.filter(name=self.name).select_for_update().values_list("pk", flat=True)))
             else:
                 # Delete only this release
                 try:
@@ -112,9 +523,8 @@ class PyPIPackage(object):
         logger.debug("[FETCH] %s%s" % (self.name, " %s" % self.version if self.version else ""))
 
         # Fetch meta data for this release
-        self.releases = self.get_releases()
-        self.release_data = self.get_release_data()
-        self.release_url_data = self.get_release_urls()
+        source = get_upstream_source()(self.name, self.version)
+        self.releases, self.release_data, self.release_url_data = source.fetch()
 
     def build(self):
         logger.debug("[BUILD] %s%s" % (self.name, " %s" % self.version if self.version else ""))
@@ -228,7 +638,35 @@ class PyPIPackage(object):
         except Package.DoesNotExist:
             package = Package.objects.create(name=self.name)
 
+        self.store_counts = {"written": 0, "skipped": 0}
+
+        # Order the releases once at the end instead of after every new release
+        with suspended_version_ordering():
+            created = self.store_releases(package)
+
+        if created:
+            update_version_ordering(package)
+
+        # Mark unsynced as deleted when bulk processing
+        if self.bulk:
+            for release in Release.objects.filter(package=package).exclude(version__in=self.data.keys()):
+                release.hidden = True
+                release.save()
+
+        logger.info("[STORE] %s %s releases written, %s skipped" % (self.name, self.store_counts["written"], self.store_counts["skipped"]))
+
+        self.stored = True
+
+    def store_releases(self, package):
+        """
+            Stores the built data of every release, returns whether any new
+            releases were created.
+        """
+        created = False
+
         for data in self.data.values():
+            data_fingerprint = fingerprint(data)
+
             try:
                 release = Release.objects.get(package=package, version=data["version"])
             except Release.DoesNotExist:
@@ -236,6 +674,13 @@ class PyPIPackage(object):
                 release.full_clean()
                 release.save()
 
+                created = True
+            else:
+                if self.skip_modified and not release.hidden and release.fingerprint == data_fingerprint:
+                    # Nothing has changed upstream since we last stored this release
+                    self.store_counts["skipped"] += 1
+                    continue
+
             # This is an extra database call but it should prevent ShareLocks
             Release.objects.filter(pk=release.pk).select_for_update()
 
@@ -248,80 +693,18 @@ class PyPIPackage(object):
                     continue
 
                 if key == "uris":
-                    ReleaseURI.objects.filter(release=release).delete()
-                    for label, uri in value.iteritems():
-                        try:
-                            ReleaseURI.objects.get(release=release, label=label, uri=uri)
-                        except ReleaseURI.DoesNotExist:
-                            try:
-                                release_uri = ReleaseURI(release=release, label=label, uri=uri)
-                                release_uri.full_clean()
-                                release_uri.save(force_insert=True)
-                            except ValidationError:
-                                logger.exception("%s, %s for %s-%s Invalid Data" % (label, uri, release.package.name, release.version))
+                    def invalid_uri(release_uri):
+                        logger.exception("%s, %s for %s-%s Invalid Data" % (release_uri.label, release_uri.uri, release.package.name, release.version))
+
+                    uris = [{"label": label, "uri": uri} for label, uri in value.iteritems()]
+                    self.store_related(release, ReleaseURI, ["label", "uri"], uris, on_invalid=invalid_uri)
                 elif key == "classifiers":
-                    release.classifiers.clear()
-                    for classifier in value:
-                        try:
-                            trove = TroveClassifier.objects.get(trove=classifier)
-                        except TroveClassifier.DoesNotExist:
-                            trove = TroveClassifier(trove=classifier)
-                            trove.full_clean()
-                            trove.save(force_insert=True)
-                        release.classifiers.add(trove)
+                    self.store_classifiers(release, value)
                 elif key in ["requires", "provides", "obsoletes"]:
                     model = {"requires": ReleaseRequire, "provides": ReleaseProvide, "obsoletes": ReleaseObsolete}.get(key)
-                    model.objects.filter(release=release).delete()
-                    for item in value:
-                        try:
-                            model.objects.get(release=release, **item)
-                        except model.DoesNotExist:
-                            m = model(release=release, **item)
-                            m.full_clean()
-                            m.save(force_insert=True)
+                    self.store_related(release, model, ["kind", "name", "version", "environment"], value)
                 elif key == "files":
-                    files = ReleaseFile.objects.filter(release=release)
-                    filenames = dict([(x.filename, x) for x in files])
-
-                    for f in value:
-                        try:
-                            rf = ReleaseFile.objects.get(
-                                    release=release,
-                                    type=f["type"],
-                                    filename=f["filename"],
-                                    python_version=f["python_version"],
-                                )
-
-                            for k, v in f.iteritems():
-                                if k in ["digests", "file", "filename", "type", "python_version"]:
-                                    continue
-                                setattr(rf, k, v)
-
-                            rf.hidden = False
-                            rf.full_clean()
-                            rf.save()
-
-                        except ReleaseFile.DoesNotExist:
-                            rf = ReleaseFile(
-                                    release=release,
-                                    type=f["type"],
-                                    filename=f["filename"],
-                                    python_version=f["python_version"],
-                                    url=f["file"],
-                                    **dict([(k, v) for k, v in f.iteritems() if k not in ["digests", "file", "filename", "type", "python_version"]])
-                                )
-
-                            rf.hidden = False
-                            rf.full_clean()
-                            rf.save()
-
-                        if f["filename"] in filenames.keys():
-                            del filenames[f["filename"]]
-
-                    if filenames:
-                        for rf in ReleaseFile.objects.filter(pk__in=[f.pk for f in filenames.values()]):
-                            rf.hidden = True
-                            rf.save()
+                    self.store_files(release, value)
                 else:
                     setattr(release, key, value)
 
@@ -336,15 +719,138 @@ class PyPIPackage(object):
                         raise
                 else:
                     break
+
+            release.fingerprint = data_fingerprint
             release.save()
 
-        # Mark unsynced as deleted when bulk processing
-        if self.bulk:
-            for release in Release.objects.filter(package=package).exclude(version__in=self.data.keys()):
-                release.hidden = True
-                release.save()
+            self.store_counts["written"] += 1
+
+        return created
+
+    def store_files(self, release, files):
+        """
+            Reconciles the ReleaseFiles of ``release`` with ``files`` working from
+            a single load of the existing files keyed by (type, filename,
+            python_version). New files are bulk inserted, existing files are only
+            written when something other than their download count changed and
+            files that are gone upstream are hidden with one update.
+        """
+        existing = dict([((rf.type, rf.filename, rf.python_version), rf) for rf in ReleaseFile.objects.filter(release=release)])
+
+        incoming = collections.OrderedDict([((f["type"], f["filename"], f["python_version"]), f) for f in files])
+
+        new = []
+        for key, f in incoming.iteritems():
+            values = dict([(k, v) for k, v in f.iteritems() if k not in ["digests", "file", "filename", "type", "python_version"]])
+            values["hidden"] = False
+
+            rf = existing.pop(key, None)
+
+            if rf is None:
+                rf = ReleaseFile(
+                        release=release,
+                        type=f["type"],
+                        filename=f["filename"],
+                        python_version=f["python_version"],
+                        url=f["file"],
+                        **values
+                    )
+                # The keyed load already tells us this is unique, skip validate_unique's query
+                rf.clean_fields()
+                new.append(rf)
+            else:
+                # Download counts of existing files are kept up to date by synchronize_downloads
+                changed = dict([(k, v) for k, v in values.iteritems() if k != "downloads" and getattr(rf, k) != v])
 
-        self.stored = True
+                if changed:
+                    for k, v in changed.iteritems():
+                        setattr(rf, k, v)
+                    rf.clean_fields()
+
+                    changed["modified"] = now()
+                    ReleaseFile.objects.filter(pk=rf.pk).update(**changed)
+
+        if new:
+            ReleaseFile.objects.bulk_create(new)
+
+        # Anything left over is no longer on PyPI
+        removed = [rf for rf in existing.values() if not rf.hidden]
+
+        if removed:
+            ReleaseFile.objects.filter(pk__in=[rf.pk for rf in removed]).update(hidden=True, modified=now())
+
+            events = []
+            for rf in removed:
+                event = Event(package=release.package.name, version=release.version, action=Event.ACTIONS.file_remove)
+
+                try:
+                    event.data = {
+                        "filename": rf.filename,
+                        "digest": rf.digest,
+                        "uri": rf.get_absolute_url(),
+                    }
+                except ValueError:
+                    pass
+
+                events.append(event)
+
+            Event.objects.bulk_create(events)
+
+    def store_classifiers(self, release, classifiers):
+        through = Release.classifiers.through
+
+        wanted = set(troves.get_ids(classifiers).values())
+        existing = set(through.objects.filter(release=release).values_list("troveclassifier_id", flat=True))
+
+        if existing - wanted:
+            through.objects.filter(release=release, troveclassifier__in=existing - wanted).delete()
+
+        if wanted - existing:
+            through.objects.bulk_create([through(release=release, troveclassifier_id=pk) for pk in wanted - existing])
+
+    def store_related(self, release, model, fields, items, on_invalid=None):
+        """
+            Makes the ``model`` rows belonging to ``release`` match ``items``, a
+            list of dicts keyed by ``fields``. Existing rows are loaded once and
+            only the difference is written, with one delete and one bulk insert.
+            New rows are validated with ``full_clean``; an invalid row is passed
+            to ``on_invalid`` if given, otherwise the ValidationError is raised.
+        """
+        existing = {}
+        for row in model.objects.filter(release=release).values_list("pk", *fields):
+            existing.setdefault(tuple(row[1:]), []).append(row[0])
+
+        wanted = set([tuple([item[f] for f in fields]) for item in items])
+
+        stale = []
+        for key, pks in existing.iteritems():
+            # Keep a single row for anything still wanted, which also clears out duplicates
+            stale.extend(pks[1:] if key in wanted else pks)
+
+        new = []
+        for item in items:
+            key = tuple([item[f] for f in fields])
+
+            if key in existing:
+                continue
+            existing[key] = []
+
+            obj = model(release=release, **item)
+
+            try:
+                obj.full_clean()
+            except ValidationError:
+                if on_invalid is None:
+                    raise
+                on_invalid(obj)
+            else:
+                new.append(obj)
+
+        if stale:
+            model.objects.filter(pk__in=stale).delete()
+
+        if new:
+            model.objects.bulk_create(new)
 
     def download(self):
         # Check to Make sure fetch has been ran
@@ -379,112 +885,46 @@ class PyPIPackage(object):
 
                 for release_file in ReleaseFile.objects.filter(release=release, filename__in=[x["filename"] for x in data["files"]]).select_for_update():
                     file_data = [x for x in data["files"] if x["filename"] == release_file.filename][0]
-
-                    datastore_key = "crate:pypi:download:%(url)s" % {"url": file_data["file"]}
-                    stored_file_data = self.datastore.hgetall(datastore_key)
-
-                    headers = None
-
-                    if stored_file_data and self.skip_modified:
-                        # Stored data exists for this file
-                        if release_file.file:
-                            try:
-                                release_file.file.read()
-                            except IOError:
-                                pass
-                            else:
-                                # We already have a file
-                                if stored_file_data["md5"].lower() == file_data["digests"]["md5"].lower():
-                                    # The supposed MD5 from PyPI matches our local
-                                    headers = {
-                                        "If-Modified-Since": stored_file_data["modified"],
-                                    }
-
-                    resp = requests.get(file_data["file"], headers=headers, prefetch=True)
-
-                    if resp.status_code == 304:
-                        logger.info("[DOWNLOAD] skipping %(filename)s because it has not been modified" % {"filename": release_file.filename})
-                        return
-                    logger.info("[DOWNLOAD] downloading %(filename)s" % {"filename": release_file.filename})
-
-                    resp.raise_for_status()
-
-                    # Make sure the MD5 of the file we receive matched what we were told it is
-                    if hashlib.md5(resp.content).hexdigest().lower() != file_data["digests"]["md5"].lower():
-                        raise PackageHashMismatch("%s does not match %s for %s %s" % (
-                                                            hashlib.md5(resp.content).hexdigest().lower(),
-                                                            file_data["digests"]["md5"].lower(),
-                                                            file_data["type"],
-                                                            file_data["filename"],
-                                                        ))
-
-                    release_file.digest = "$".join(["sha256", hashlib.sha256(resp.content).hexdigest().lower()])
-
-                    release_file.full_clean()
-                    release_file.file.save(file_data["filename"], ContentFile(resp.content), save=False)
-                    release_file.save()
-
-                    Event.objects.create(
-                        package=release_file.release.package.name,
-                        version=release_file.release.version,
-                        action=Event.ACTIONS.file_add,
-                        data={
-                            "filename": release_file.filename,
-                            "digest": release_file.digest,
-                            "uri": release_file.get_absolute_url(),
-                        }
-                    )
-
-                    # Store data relating to this file (if modified etc)
-                    stored_file_data = {
-                        "md5": file_data["digests"]["md5"].lower(),
-                        "modified": resp.headers.get("Last-Modified"),
-                    }
-
-                    if resp.headers.get("Last-Modified"):
-                        self.datastore.hmset(datastore_key, {
-                            "md5": file_data["digests"]["md5"].lower(),
-                            "modified": resp.headers["Last-Modified"],
-                        })
-                        # Set a year expire on the key so that stale entries disappear
-                        self.datastore.expire(datastore_key, 31556926)
-                    else:
-                        self.datastore.delete(datastore_key)
+                    download_release_file(release_file, file_data, self.datastore, skip_modified=self.skip_modified)
             except requests.HTTPError:
                 logger.exception("[DOWNLOAD ERROR]")
 
-    def get_releases(self):
-        if self.version is None:
-            releases = self.pypi.package_releases(self.name, True)
-        else:
-            releases = [self.version]
+    def mirror(self):
+        """
+            Queues every file of the fetched releases that we do not already
+            have an up to date copy of for mirroring by the mirror_file task.
+        """
+        from crate.pypi.tasks import mirror_file
 
-        logger.debug("[RELEASES] %s%s [%s]" % (self.name, " %s" % self.version if self.version else "", ", ".join(releases)))
-
-        return releases
+        if not self.stored:
+            raise Exception("package must be stored prior to mirroring")  # @@@ Make a Custom Exception
 
-    def get_release_data(self):
-        release_data = []
-        for release in self.releases:
-            data = self.pypi.release_data(self.name, release)
-            logger.debug("[RELEASE DATA] %s %s" % (self.name, release))
-            release_data.append([release, data])
-        return dict(release_data)
+        for data in self.data.values():
+            digests = dict([(x["filename"], x["digests"]["md5"].lower()) for x in data["files"]])
+
+            release_files = list(ReleaseFile.objects.filter(
+                                    release__package__name=data["package"],
+                                    release__version=data["version"],
+                                    filename__in=digests.keys(),
+                                    hidden=False,
+                                ).only("pk", "filename", "url", "file"))
+
+            pipe = self.datastore.pipeline()
+            for release_file in release_files:
+                pipe.hget("crate:pypi:download:%(url)s" % {"url": release_file.url}, "md5")
+            mirrored = pipe.execute()
+
+            for release_file, md5_hash in zip(release_files, mirrored):
+                if release_file.file and md5_hash == digests[release_file.filename]:
+                    continue
 
-    def get_release_urls(self):
-        release_url_data = []
-        for release in self.releases:
-            data = self.pypi.release_urls(self.name, release)
-            logger.info("[RELEASE URL] %s %s" % (self.name, release))
-            logger.debug("[RELEASE URL DATA] %s %s %s" % (self.name, release, data))
-            release_url_data.append([release, data])
-        return dict(release_url_data)
+                mirror_file.delay(release_file.pk, digests[release_file.filename])
 
     def verify_and_sync_pages(self):
         # Get the Server Key for PyPI
         try:
             # Download the "simple" page from PyPI for this package
-            simple = requests.get(urlparse.urljoin(SIMPLE_URL, urllib.quote(self.name.encode("utf-8"))), prefetch=True)
+            simple = client.get(urlparse.urljoin(SIMPLE_URL, urllib.quote(self.name.encode("utf-8"))), prefetch=True)
             simple.raise_for_status()
         except requests.HTTPError:
             if simple.status_code == 404:
@@ -1,25 +1,37 @@
 import base64
 import datetime
+import hashlib
 import logging
+import posixpath
 import re
+import tempfile
+import urllib
 
 import redis
 import requests
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.files import File
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponsePermanentRedirect, Http404
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseNotModified, HttpResponsePermanentRedirect, HttpResponseRedirect, Http404
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext as _
 from django.views.decorators.cache import cache_page
 from django.views.generic.detail import DetailView
 
-from crate.web.packages.models import ReleaseFile
+from crate.web.packages.models import ReleaseFile, get_content_disposition
+from crate.pypi import client
 from crate.pypi.models import PyPIMirrorPage, PyPIServerSigPage, PyPIIndexPage
+from crate.pypi.processor import get_release_file_lock, get_upstream_md5, record_download, save_release_file
 
 PYPI_SINCE_KEY = "crate:pypi:since"
 
+SENDFILE_HEADERS = {
+    "x-accel-redirect": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile",
+}
+
 logger = logging.getLogger(__name__)
 
 
@@ -160,7 +172,207 @@ def last_modified(request):
 
 def file_redirect(request, filename):
     release_file = get_object_or_404(ReleaseFile, filename=filename)
-    return HttpResponsePermanentRedirect(release_file.file.url)
+
+    if release_file.file:
+        if getattr(settings, "PYPI_FILE_SENDFILE", None):
+            response = sendfile(request, release_file)
+            if response is not None:
+                return response
+
+        return HttpResponsePermanentRedirect(release_file.file.url)
+
+    if not release_file.url:
+        raise Http404(_(u"%(filename)s has not been mirrored") % {"filename": filename})
+
+    if getattr(settings, "PYPI_PULL_THROUGH", False):
+        return pull_through(request, release_file)
+
+    return HttpResponseRedirect(release_file.url)
+
+
+def sendfile(request, release_file):
+    """
+    Hands a locally stored file off to the front end proxy with an internal
+    redirect header, so the proxy sends the bytes (and handles Range
+    requests) while we only look the file up. Returns None if the file is
+    not on local disk.
+    """
+    storage = release_file.file.storage
+
+    try:
+        path = storage.path(release_file.file.name)
+    except NotImplementedError:
+        return None
+
+    etag = None
+    if "$" in release_file.digest:
+        etag = '"%s"' % release_file.digest.split("$", 1)[1]
+
+        if_none_match = [x.strip() for x in request.META.get("HTTP_IF_NONE_MATCH", "").split(",")]
+        if etag in if_none_match or "*" in if_none_match:
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+    response = HttpResponse(mimetype="application/octet-stream")
+
+    if settings.PYPI_FILE_SENDFILE == "x-accel-redirect":
+        internal = posixpath.join(getattr(settings, "PYPI_FILE_ACCEL_PREFIX", "/internal/packages/"), release_file.file.name)
+        response[SENDFILE_HEADERS["x-accel-redirect"]] = urllib.quote(internal.encode("utf-8"))
+    else:
+        response[SENDFILE_HEADERS["x-sendfile"]] = path
+
+    response["Content-Length"] = storage.size(release_file.file.name)
+    response["Content-Disposition"] = get_content_disposition(release_file.filename)
+    response["Accept-Ranges"] = "bytes"
+
+    if etag is not None:
+        response["ETag"] = etag
+
+    return response
+
+
+def pull_through(request, release_file):
+    """
+    Serves a file that has not been mirrored yet straight from upstream,
+    storing it on the way through so later requests are served locally.
+    Only one request per file fetches it (sharing the lock with the mirror
+    task), everyone else gets sent upstream until it is stored. Files whose
+    md5 PyPI does not tell us are never stored, they could not be verified.
+    Anything but a GET is sent upstream, a HEAD response's body is never
+    read so the file would not be stored anyway.
+    """
+    if request.method != "GET":
+        return HttpResponseRedirect(release_file.url)
+
+    lock = get_release_file_lock(release_file)
+
+    if not lock.acquire(blocking=False):
+        return HttpResponseRedirect(release_file.url)
+
+    expected_md5 = get_upstream_md5(release_file)
+
+    if expected_md5 is None:
+        lock.release()
+        return HttpResponseRedirect(release_file.url)
+
+    try:
+        resp = client.get(release_file.url, prefetch=False)
+    except requests.RequestException:
+        lock.release()
+        logger.exception("[PULL THROUGH] %s" % release_file.url)
+        return HttpResponseRedirect(release_file.url)
+
+    if resp.status_code != 200:
+        lock.release()
+        return HttpResponseRedirect(release_file.url)
+
+    response = HttpResponse(PullThroughStream(release_file, resp, expected_md5, lock), mimetype="application/octet-stream")
+
+    if resp.headers.get("Content-Length"):
+        response["Content-Length"] = resp.headers["Content-Length"]
+
+    return response
+
+
+class PullThroughStream(object):
+    """
+    Iterates over the upstream response in chunks while spooling it to a
+    temporary file, then stores that file once the client has the last chunk
+    and it matches ``expected_md5``. If the client goes away part way
+    through nothing is stored.
+
+    The server calls close() once it is done with the response, however far
+    it got, which releases ``lock`` and the upstream connection even if the
+    body was never iterated at all.
+    """
+
+    def __init__(self, release_file, resp, expected_md5, lock):
+        self.release_file = release_file
+        self.resp = resp
+        self.expected_md5 = expected_md5
+        self.lock = lock
+
+        self.chunks = None
+        self.finished = False
+        self.released = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.chunks is None:
+            self.chunks = self.stream()
+        return self.chunks.next()
+
+    def close(self):
+        if self.chunks is not None:
+            # Runs the stream's cleanup if it stopped part way through
+            self.chunks.close()
+
+        self.release()
+
+    def release(self):
+        if self.released:
+            return
+
+        self.released = True
+
+        if not self.finished:
+            # Drop the connection, it can not go back in the pool with a body still unread
+            fp = getattr(self.resp.raw, "_fp", None)
+            if fp is not None:
+                fp.close()
+
+        self.lock.release()
+
+    def stream(self):
+        release_file = self.release_file
+
+        chunk_size = getattr(settings, "PYPI_DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        size = 0
+
+        fp = tempfile.TemporaryFile()
+
+        try:
+            for chunk in self.resp.iter_content(chunk_size):
+                md5.update(chunk)
+                sha256.update(chunk)
+                fp.write(chunk)
+                size += len(chunk)
+
+                yield chunk
+
+            self.finished = True
+
+            if self.resp.headers.get("Content-Length") and int(self.resp.headers["Content-Length"]) != size:
+                logger.error("[PULL THROUGH] %s was truncated at %s bytes" % (release_file.url, size))
+                return
+
+            if md5.hexdigest().lower() != self.expected_md5:
+                logger.error("[PULL THROUGH] %s md5 mismatch, expected %s got %s" % (release_file.url, self.expected_md5, md5.hexdigest().lower()))
+                return
+
+            fp.seek(0)
+
+            content = File(fp)
+            content.size = size
+
+            try:
+                save_release_file(release_file, content, sha256.hexdigest().lower())
+            except Exception:
+                logger.exception("[PULL THROUGH] could not store %s" % release_file.url)
+            else:
+                # Lets mirror() know the file is already stored
+                record_download(client.get_datastore(), release_file.url, self.expected_md5, self.resp.headers.get("Last-Modified"))
+        finally:
+            fp.close()
+            # Middleware reading response.content replaces our iterator, so
+            # close() may never be called, release as soon as we are done
+            self.release()
 
 
 def simple_redirect(request):
@@ -1,11 +1,10 @@
 import collections
 import datetime
-import hashlib
+import json
 import logging
 import re
 import socket
 import time
-import xmlrpclib
 
 import redis
 import requests
@@ -16,18 +15,28 @@ from django.conf import settings
 from django.db import transaction
 from django.utils.timezone import now
 
+from crate.pypi import client
+from crate.pypi.exceptions import PackageHashMismatch
+from crate.pypi.utils import troves
 from crate.pypi.utils.lock import Lock
+from crate.pypi.utils.delete import delete_packages
+from crate.pypi.utils.throttle import Semaphore, BandwidthBudget
 from crate.web.packages.models import Package, ReleaseFile, TroveClassifier, DownloadDelta
 from crate.pypi.models import PyPIIndexPage, PyPIDownloadChange
-from crate.pypi.processor import PyPIPackage
+from crate.pypi.processor import PyPIPackage, download_release_file, get_release_file_lock
 
 logger = logging.getLogger(__name__)
 
-INDEX_URL = "http://pypi.python.org/pypi"
-
 CLASSIFIER_URL = "http://pypi.python.org/pypi?%3Aaction=list_classifiers"
 
 PYPI_SINCE_KEY = "crate:pypi:since"
+PYPI_SERIAL_KEY = "crate:pypi:serial"
+
+PYPI_BULK_KEY = "crate:pypi:bulk"
+PYPI_BULK_NAMES_KEY = "crate:pypi:bulk:names"
+PYPI_BULK_DONE_KEY = "crate:pypi:bulk:done"
+PYPI_BULK_FAILED_KEY = "crate:pypi:bulk:failed"
+PYPI_BULK_QUEUED_KEY = "crate:pypi:bulk:queued"
 
 
 def process(name, version, timestamp, action, matches):
@@ -45,86 +54,501 @@ def remove_file(name, version, timestamp, action, matches):
     package.remove_files(*matches.groups())
 
 
-@task
+CHANGELOG_DISPATCH = collections.OrderedDict([
+    (re.compile("^create$"), process),
+    (re.compile("^new release$"), process),
+    (re.compile("^add [\w\d\.]+ file .+$"), process),
+    (re.compile("^remove$"), remove),
+    (re.compile("^remove file (.+)$"), remove_file),
+    (re.compile("^update [\w]+(, [\w]+)*$"), process),
+    #(re.compile("^docupdate$"), docupdate),  # @@@ Do Something
+    #(re.compile("^add (Owner|Maintainer) .+$"), add_user_role),  # @@@ Do Something
+    #(re.compile("^remove (Owner|Maintainer) .+$"), remove_user_role),  # @@@ Do Something
+])
+
+
+def coalesce_changes(changes):
+    """
+        Collapses a window of changelog lines, given in order as
+        (name, version, timestamp, action, func, matches, serial)
+        tuples, into the fewest operations with the same end result. Each
+        operation fetches the current state from PyPI when it runs, so:
+
+        * one process call per release covers every create, new release,
+          add file, update and remove file line for it
+        * removing a release, or a whole package, supersedes anything
+          queued for it earlier in the window, lines after it still run
+
+        Returns an (operations, serials) pair per release in the order they
+        should run, where the serials are every line the operations
+        account for.
+    """
+    queued = collections.OrderedDict()
+
+    for change in changes:
+        name, version, timestamp, action, func, matches, serial = change
+
+        if func is remove:
+            serials = set([serial])
+            for key in [k for k in queued if k == (name, version) or (version is None and k[0] == name)]:
+                serials |= queued.pop(key)[1]
+            queued[(name, version)] = ([change], serials)
+            continue
+
+        operations, serials = queued.setdefault((name, version), ([], set()))
+        serials.add(serial)
+
+        if any([x[4] is process for x in operations]):
+            continue
+
+        if func is process:
+            # Processing the release hides removed files as well
+            operations[:] = [x for x in operations if x[4] is not remove_file]
+
+        operations.append(change)
+
+    return queued.values()
+
+
+def get_package_lock(name):
+    return Lock("crate:pypi:package:%s" % name, expires=60 * 30)
+
+
+def get_package_changes_key(name):
+    return "crate:pypi:package:%s:changes" % name
+
+
+def get_package_failures_key(name):
+    return "crate:pypi:package:%s:failures" % name
+
+
+@task(max_retries=None)
+def process_package_changes(name):
+    """
+        Applies the (version, timestamp, action) changelog operations queued
+        for a single package, oldest first. dispatch_changes pushes them on
+        to the package's list in changelog order and whichever task holds
+        the package lock drains it, so they always run in the order they
+        happened even when a later poll's task gets to run first. Failures
+        of the operation at the head of the list are counted next to it, so
+        new changes for the package do not restart its backoff.
+    """
+    datastore = client.get_datastore()
+    key = get_package_changes_key(name)
+    failures_key = get_package_failures_key(name)
+
+    lock = get_package_lock(name)
+
+    if not lock.acquire(blocking=False):
+        # The holder drains our operations too, unless it saw the list empty
+        # just before they were pushed, so check back once it is done
+        process_package_changes.retry(countdown=10)
+
+    try:
+        next_attempt = datastore.hget(failures_key, "next_attempt")
+
+        if next_attempt and float(next_attempt) > time.time() + 1:
+            # The head of the list is backing off, the retry queued when it failed drains the rest
+            return
+
+        while True:
+            change = datastore.lindex(key, 0)
+
+            if change is None:
+                break
+
+            version, timestamp, action = json.loads(change)
+
+            try:
+                for pattern, func in CHANGELOG_DISPATCH.iteritems():
+                    matches = pattern.search(action)
+                    if matches is not None:
+                        func(name, version, timestamp, action, matches)
+                        break
+            except Exception as exc:
+                attempts = datastore.hincrby(failures_key, "attempts", 1)
+
+                if attempts <= 5:
+                    # The operation stays at the head of the list so nothing after it runs first
+                    countdown = 60 * 2 ** (attempts - 1)
+                    datastore.hset(failures_key, "next_attempt", time.time() + countdown)
+
+                    logger.exception("[PROCESS] %s failed, retrying in %ss" % (name, countdown))
+                    process_package_changes.retry(args=[name], exc=exc, countdown=countdown)
+
+                logger.exception("[PROCESS] giving up on %s %s %s" % (name, version, action))
+
+            # Only taken off the list once done with so a retry picks up here
+            pipe = datastore.pipeline()
+            pipe.lpop(key)
+            pipe.delete(failures_key)
+            pipe.execute()
+    finally:
+        lock.release()
+
+
+@task(max_retries=None)
 def bulk_process(name, version, timestamp, action, matches):
-    package = PyPIPackage(name)
-    package.process(bulk=True)
+    lock = get_package_lock(name)
+
+    if not lock.acquire(blocking=False):
+        bulk_process.retry(countdown=10)
+
+    try:
+        package = PyPIPackage(name)
+        package.process(bulk=True)
+    finally:
+        lock.release()
+
+
+def reconcile_packages(names, batch_size=1000, dry_run=False):
+    """
+        Deletes local packages that are no longer in ``names``, the full
+        upstream package list, and returns the normalized names of the
+        packages that were (or with ``dry_run`` would have been) deleted.
+
+        Local packages are read a batch at a time in primary key order and
+        compared against the normalized upstream names, so neither side
+        ends up in a giant NOT IN and deletes go out a batch at a time.
+    """
+    if not names:
+        # An empty list means something went wrong upstream, not that PyPI is empty
+        logger.warn("[RECONCILE] no upstream packages, refusing to delete everything")
+        return []
+
+    upstream = set([re.sub("[^A-Za-z0-9.]+", "-", name).lower() for name in names])
+
+    drifted = []
+    last_pk = 0
+
+    while True:
+        batch = list(Package.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", "normalized_name")[:batch_size])
+
+        if not batch:
+            break
+
+        last_pk = batch[-1][0]
+
+        missing = [(pk, normalized_name) for pk, normalized_name in batch if normalized_name not in upstream]
+
+        if not missing:
+            continue
+
+        drifted.extend([normalized_name for pk, normalized_name in missing])
+
+        if dry_run:
+            for pk, normalized_name in missing:
+                logger.info("[RECONCILE] %s is gone upstream" % normalized_name)
+        else:
+            delete_packages([pk for pk, normalized_name in missing])
+            logger.info("[RECONCILE] deleted %s packages that are gone upstream" % len(missing))
+
+    return drifted
+
+
+@task
+def bulk_process_chunk(index, queued=None):
+    """
+        Processes one PYPI_BULK_CHUNK_SIZE slice of the package names
+        snapshotted by bulk_synchronize and records it as done. ``queued``
+        is when bulk_synchronize queued it, a chunk that has been queued
+        again since stops so the two never process the same packages.
+    """
+    datastore = client.get_datastore()
+
+    bulk = datastore.hgetall(PYPI_BULK_KEY)
+    if not bulk:
+        # The bulk sync this chunk belongs to has finished or been reset
+        return
+
+    chunk_size = int(bulk["chunk_size"])
+    names = datastore.lrange(PYPI_BULK_NAMES_KEY, index * chunk_size, (index + 1) * chunk_size - 1)
+
+    for name in names:
+        if datastore.hget(PYPI_BULK_QUEUED_KEY, index) != queued:
+            logger.info("[BULK] chunk %s was queued again, leaving it to the newer task" % index)
+            return
+
+        name = name.decode("utf-8")
+        lock = get_package_lock(name)
+
+        if not lock.acquire(blocking=False):
+            # A changelog task is storing this package right now, which is as good
+            continue
+
+        try:
+            PyPIPackage(name).process(bulk=True)
+        except Exception:
+            logger.exception("[BULK] %s failed" % name)
+            datastore.sadd(PYPI_BULK_FAILED_KEY, name)
+        finally:
+            lock.release()
+
+    datastore.sadd(PYPI_BULK_DONE_KEY, index)
+
+    done = datastore.scard(PYPI_BULK_DONE_KEY)
+    total = int(bulk["chunks"])
+
+    logger.info("[BULK] chunk %s done, %s of %s chunks" % (index, done, total))
+
+    if done >= total:
+        logger.info("[BULK] finished, %s packages failed" % datastore.scard(PYPI_BULK_FAILED_KEY))
+        datastore.delete(PYPI_BULK_KEY, PYPI_BULK_NAMES_KEY, PYPI_BULK_DONE_KEY, PYPI_BULK_QUEUED_KEY)
 
 
 @task
 def bulk_synchronize():
-    pypi = xmlrpclib.ServerProxy(INDEX_URL)
+    """
+        Processes every package on PyPI, PYPI_BULK_CHUNK_SIZE packages per
+        task. The package list is snapshotted in Redis along with when each
+        chunk was queued and which are done, so running this again while a
+        bulk sync is unfinished only queues the chunks that have not
+        completed and have not been queued in the last
+        PYPI_BULK_CHUNK_TIMEOUT seconds.
+    """
+    datastore = client.get_datastore()
+    pypi = client.get_pypi()
+
+    # Always reconcile against the current list, packages may have been created since the snapshot
+    names = sorted(pypi.list_packages())
+
+    if not datastore.exists(PYPI_BULK_KEY):
+        if not names:
+            # An empty list means something went wrong upstream, a snapshot of it would never finish
+            logger.warn("[BULK] no upstream packages, not starting a bulk sync")
+            return
+
+        chunk_size = getattr(settings, "PYPI_BULK_CHUNK_SIZE", 500)
+
+        pipe = datastore.pipeline()
+        pipe.delete(PYPI_BULK_NAMES_KEY, PYPI_BULK_DONE_KEY, PYPI_BULK_FAILED_KEY, PYPI_BULK_QUEUED_KEY)
+        for i in xrange(0, len(names), 10000):
+            pipe.rpush(PYPI_BULK_NAMES_KEY, *[name.encode("utf-8") for name in names[i:i + 10000]])
+        pipe.hmset(PYPI_BULK_KEY, {
+            "chunk_size": chunk_size,
+            "chunks": (len(names) + chunk_size - 1) // chunk_size,
+            "packages": len(names),
+            "started": time.time(),
+        })
+        pipe.execute()
+    else:
+        logger.info("[BULK] resuming the unfinished bulk sync")
+
+    chunks = int(datastore.hget(PYPI_BULK_KEY, "chunks"))
+
+    if not chunks:
+        # Left behind by an empty package list, there is nothing to resume
+        datastore.delete(PYPI_BULK_KEY, PYPI_BULK_NAMES_KEY, PYPI_BULK_DONE_KEY, PYPI_BULK_QUEUED_KEY)
+        return
+
+    done = datastore.smembers(PYPI_BULK_DONE_KEY)
+    queued = datastore.hgetall(PYPI_BULK_QUEUED_KEY)
+
+    # Chunks queued longer ago than this are assumed lost along with their worker
+    stale = time.time() - getattr(settings, "PYPI_BULK_CHUNK_TIMEOUT", 60 * 60 * 6)
+
+    for index in xrange(chunks):
+        if str(index) in done:
+            continue
+
+        if str(index) in queued and float(queued[str(index)]) > stale:
+            continue
+
+        when = repr(time.time())
+        datastore.hset(PYPI_BULK_QUEUED_KEY, index, when)
+        bulk_process_chunk.delay(index, when)
+
+    reconcile_packages(names)
+
+
+def get_start_serial(pypi, datastore):
+    """
+        Returns the journal serial to sync from, moving deployments that
+        only have the old timestamp marker over to the serial cursor.
+    """
+    serial = datastore.get(PYPI_SERIAL_KEY)
+    if serial is not None:
+        return int(serial)
+
+    since = datastore.get(PYPI_SINCE_KEY)
+    if since is not None:
+        changes = pypi.changelog(int(float(since)) - 30, True)
+        if changes:
+            return min([change[4] for change in changes]) - 1
+        return pypi.changelog_last_serial()
+
+    return None
+
+
+def advance_serial(datastore, expected, serial):
+    """
+        Moves the stored serial from ``expected`` to ``serial`` atomically,
+        returning False if something else changed it in the meantime.
+    """
+    with datastore.pipeline() as pipe:
+        try:
+            pipe.watch(PYPI_SERIAL_KEY)
+
+            current = pipe.get(PYPI_SERIAL_KEY)
+            if current is not None and int(current) != expected:
+                return False
+
+            pipe.multi()
+            pipe.set(PYPI_SERIAL_KEY, serial)
+            pipe.execute()
+        except redis.WatchError:
+            return False
+
+    return True
+
+
+def dispatch_changes(pypi, datastore, serial):
+    """
+        Queues processing for every changelog entry after ``serial`` and
+        advances the stored serial past them. Returns the changes.
+    """
+    logger.debug("[SYNCING] Changes since serial %s" % serial)
+    changes = pypi.changelog_since_serial(serial)
+
+    counts = {"seen": len(changes), "coalesced": 0, "dispatched": 0}
+
+    pending = []
+
+    for name, version, timestamp, action, change_serial in changes:
+        logdata = {"action": action, "name": name, "version": version, "timestamp": timestamp, "serial": change_serial}
+        logger.debug("[PROCESS] %(serial)s %(name)s %(version)s %(timestamp)s %(action)s" % logdata)
+
+        # Dispatch Based on the action
+        for pattern, func in CHANGELOG_DISPATCH.iteritems():
+            matches = pattern.search(action)
+            if matches is not None:
+                pending.append((name, version, timestamp, action, func, matches, change_serial))
+                break
+        else:
+            logger.warn("[UNHANDLED] %(serial)s %(name)s %(version)s %(timestamp)s %(action)s" % logdata)
+
+    # Hand each package's operations to a worker
+    packages = collections.OrderedDict()
+    for operations, serials in coalesce_changes(pending):
+        queued = packages.setdefault(operations[0][0], [])
+        queued.extend([(version, timestamp, action) for name, version, timestamp, action, func, matches, change_serial in operations])
 
-    names = set()
+    for name, operations in packages.iteritems():
+        pipe = datastore.pipeline()
+        for operation in operations:
+            pipe.rpush(get_package_changes_key(name), json.dumps(operation))
+        pipe.execute()
 
-    for package in pypi.list_packages():
-        names.add(package)
-        bulk_process.delay(package, None, None, None, None)
+        process_package_changes.delay(name)
+        counts["dispatched"] += len(operations)
 
-    for package in Package.objects.exclude(name__in=names):
-        package.delete()
+    if changes:
+        last_serial = max([change[4] for change in changes])
+        if not advance_serial(datastore, serial, last_serial):
+            logger.warn("[SYNCING] serial moved on from %s while syncing, not advancing it to %s" % (serial, last_serial))
+
+    counts["coalesced"] = len(pending) - counts["dispatched"]
+
+    if changes:
+        logger.info("[SYNCED] %(seen)s changes seen, %(coalesced)s coalesced, %(dispatched)s dispatched" % counts)
+
+    return changes
 
 
 @task
-def synchronize(since=None):
+def synchronize(serial=None):
     with Lock("synchronize", expires=60 * 5, timeout=30):
-        datastore = redis.StrictRedis(**dict([(x.lower(), y) for x, y in settings.REDIS[settings.PYPI_DATASTORE].items()]))
+        datastore = client.get_datastore()
+        pypi = client.get_pypi()
 
-        if since is None:
-            s = datastore.get(PYPI_SINCE_KEY)
-            if s is not None:
-                since = int(float(s)) - 30
+        if serial is None:
+            serial = get_start_serial(pypi, datastore)
 
         current = time.mktime(datetime.datetime.utcnow().timetuple())
 
-        pypi = xmlrpclib.ServerProxy(INDEX_URL)
-
-        if since is None:  # @@@ Should we do this for more than just initial?
+        if serial is None:  # @@@ Should we do this for more than just initial?
+            # Anything that changes while the bulk sync runs is picked up from here on
+            datastore.set(PYPI_SERIAL_KEY, pypi.changelog_last_serial())
             bulk_synchronize.delay()
         else:
-            logger.info("[SYNCING] Changes since %s" % since)
-            changes = pypi.changelog(since)
-
-            for name, version, timestamp, action in changes:
-                line_hash = hashlib.sha256(u":".join([unicode(x) for x in (name, version, timestamp, action)]).encode("utf-8")).hexdigest()
-                logdata = {"action": action, "name": name, "version": version, "timestamp": timestamp, "hash": line_hash}
-
-                if not datastore.exists("crate:pypi:changelog:%s" % line_hash):
-                    logger.debug("[PROCESS] %(name)s %(version)s %(timestamp)s %(action)s" % logdata)
-                    logger.debug("[HASH] %(name)s %(version)s %(hash)s" % logdata)
-
-                    dispatch = collections.OrderedDict([
-                        (re.compile("^create$"), process),
-                        (re.compile("^new release$"), process),
-                        (re.compile("^add [\w\d\.]+ file .+$"), process),
-                        (re.compile("^remove$"), remove),
-                        (re.compile("^remove file (.+)$"), remove_file),
-                        (re.compile("^update [\w]+(, [\w]+)*$"), process),
-                        #(re.compile("^docupdate$"), docupdate),  # @@@ Do Something
-                        #(re.compile("^add (Owner|Maintainer) .+$"), add_user_role),  # @@@ Do Something
-                        #(re.compile("^remove (Owner|Maintainer) .+$"), remove_user_role),  # @@@ Do Something
-                    ])
-
-                    # Dispatch Based on the action
-                    for pattern, func in dispatch.iteritems():
-                        matches = pattern.search(action)
-                        if matches is not None:
-                            func(name, version, timestamp, action, matches)
-                            break
-                    else:
-                        logger.warn("[UNHANDLED] %(name)s %(version)s %(timestamp)s %(action)s" % logdata)
-
-                    datastore.setex("crate:pypi:changelog:%s" % line_hash, 2629743, datetime.datetime.utcnow().isoformat())
-                else:
-                    logger.debug("[SKIP] %(name)s %(version)s %(timestamp)s %(action)s" % logdata)
-                    logger.debug("[HASH] %(name)s %(version)s %(hash)s" % logdata)
+            dispatch_changes(pypi, datastore, serial)
 
+        # Still kept up to date for the last-modified view
         datastore.set(PYPI_SINCE_KEY, current)
 
+        logger.info("[HTTP POOL] %(requests)s requests, %(connections)s connections, %(reused)s reused" % client.stats())
+
+
+@task(max_retries=None)
+def mirror_file(release_file_id, md5_digest):
+    """
+        Mirrors a single ReleaseFile into package storage. At most
+        PYPI_MIRROR_CONCURRENCY of these download at once across every
+        worker, sharing PYPI_MIRROR_BANDWIDTH bytes per second between them.
+        Failures are retried with exponential backoff up to
+        PYPI_MIRROR_MAX_ATTEMPTS times, with the retry state kept in the
+        file's crate:pypi:download:<url> hash.
+    """
+    try:
+        release_file = ReleaseFile.objects.select_related("release", "release__package").get(pk=release_file_id, hidden=False)
+    except ReleaseFile.DoesNotExist:
+        # The file has been removed since it was queued
+        return
+
+    if not release_file.url:
+        return
+
+    datastore = client.get_datastore()
+    datastore_key = "crate:pypi:download:%(url)s" % {"url": release_file.url}
+
+    slots = Semaphore("crate:pypi:mirror", getattr(settings, "PYPI_MIRROR_CONCURRENCY", 4))
+    budget = BandwidthBudget("crate:pypi:mirror", getattr(settings, "PYPI_MIRROR_BANDWIDTH", 0))
+
+    # Wait here for a free download slot rather than bouncing the task
+    # through the broker, the mirror queue's own worker concurrency keeps
+    # the number of tasks waiting like this small
+    token = slots.acquire(timeout=None)
+
+    file_data = {
+        "file": release_file.url,
+        "filename": release_file.filename,
+        "type": release_file.type,
+        "digests": {"md5": md5_digest},
+    }
+
+    lock = get_release_file_lock(release_file)
+
+    if not lock.acquire(blocking=False):
+        # Another worker or a pull through request is already downloading this file
+        slots.release(token)
+        return
+
+    try:
+        download_release_file(release_file, file_data, datastore, callback=budget.consume)
+    except (requests.RequestException, PackageHashMismatch, IOError) as exc:
+        attempts = datastore.hincrby(datastore_key, "attempts", 1)
+
+        if attempts >= getattr(settings, "PYPI_MIRROR_MAX_ATTEMPTS", 5):
+            datastore.hmset(datastore_key, {"last_error": repr(exc), "next_attempt": ""})
+            logger.error("[MIRROR] giving up on %s after %s attempts: %r" % (release_file.filename, attempts, exc))
+            return
+
+        countdown = 60 * 2 ** (attempts - 1)
+        datastore.hmset(datastore_key, {"last_error": repr(exc), "next_attempt": time.time() + countdown})
+        datastore.expire(datastore_key, 31556926)
+
+        logger.warning("[MIRROR] attempt %s for %s failed, retrying in %ss: %r" % (attempts, release_file.filename, countdown, exc))
+        mirror_file.retry(exc=exc, countdown=countdown)
+    finally:
+        lock.release()
+        slots.release(token)
+
+    datastore.hdel(datastore_key, "attempts", "last_error", "next_attempt")
+
 
 @task
 def synchronize_troves():
-    resp = requests.get(CLASSIFIER_URL)
+    resp = client.get(CLASSIFIER_URL)
     resp.raise_for_status()
 
     current_troves = set(TroveClassifier.objects.all().values_list("trove", flat=True))
@@ -134,6 +558,8 @@ def synchronize_troves():
         for classifier in new_troves:
             TroveClassifier.objects.get_or_create(trove=classifier)
 
+    troves.refresh()
+
 
 @task
 def synchronize_downloads():
@@ -147,7 +573,7 @@ def synchronize_downloads():
 @task
 def update_download_counts(package_name, version, files, index=None):
     try:
-        pypi = xmlrpclib.ServerProxy(INDEX_URL)
+        pypi = client.get_pypi()
 
         downloads = pypi.release_downloads(package_name, version)
 
@@ -168,7 +594,7 @@ def update_download_counts(package_name, version, files, index=None):
 
 @task
 def refresh_pypi_package_index_cache():
-    r = requests.get("http://pypi.python.org/simple/", prefetch=True)
+    r = client.get("http://pypi.python.org/simple/", prefetch=True)
     PyPIIndexPage.objects.create(content=r.content)
 
 
@@ -0,0 +1,103 @@
+"""
+Set based deletion of whole packages.
+
+Model.delete collects every related row into memory and deletes them one
+collector pass at a time, sending post_delete for each row as it goes.
+For a package with hundreds of releases that means thousands of queries,
+history events and search and index refresh tasks. delete_packages instead
+deletes each table's rows with a single DELETE ... WHERE ... IN (SELECT ...)
+leaf tables first, then sends one notification of each kind per package.
+"""
+import logging
+
+from django.db import transaction
+from django.db.models.sql import DeleteQuery
+
+from haystack import connections
+from haystack.exceptions import NotHandled
+
+from crate.web.history.models import Event
+from crate.web.lists.models import List
+from crate.web.packages.models import Package, PackageURI, ReadTheDocsPackageSlug, ChangeLog
+from crate.web.packages.models import Release, ReleaseFile, ReleaseURI, ReleaseRequire, ReleaseProvide, ReleaseObsolete
+from crate.web.packages.models import DownloadDelta
+from crate.pypi.models import PyPIMirrorPage, PyPIServerSigPage, PyPIDownloadChange
+
+logger = logging.getLogger(__name__)
+
+
+def raw_delete(queryset):
+    """
+    Deletes the rows matched by ``queryset`` with one DELETE statement,
+    without collecting related rows or sending any signals. The filters
+    must not need a join. Returns the number of rows deleted.
+    """
+    query = queryset.order_by().query.clone(DeleteQuery)
+    cursor = query.get_compiler(queryset.db).execute_sql(None)
+    return cursor.rowcount if cursor is not None else 0
+
+
+def delete_packages(pks):
+    """
+    Deletes the packages with the given primary keys and everything that
+    hangs off them in one transaction, then records a package_delete event
+    and queues a search index removal for each package and refreshes both
+    simple indexes once.
+    """
+    # Full instances, the search index builds its identifiers from the model
+    # and a deferred one (.only) names a proxy class instead of Package
+    packages = list(Package.objects.filter(pk__in=pks))
+
+    if not packages:
+        return
+
+    pks = [package.pk for package in packages]
+
+    releases = Release.objects.filter(package__in=pks).values("pk")
+    files = ReleaseFile.objects.filter(release__in=releases).values("pk")
+
+    # Leaf tables first so no statement trips over a foreign key
+    deletes = [
+        DownloadDelta.objects.filter(file__in=files),
+        PyPIDownloadChange.objects.filter(file__in=files),
+        ReleaseFile.objects.filter(release__in=releases),
+        ReleaseURI.objects.filter(release__in=releases),
+        ReleaseRequire.objects.filter(release__in=releases),
+        ReleaseProvide.objects.filter(release__in=releases),
+        ReleaseObsolete.objects.filter(release__in=releases),
+        Release.classifiers.through.objects.filter(release__in=releases),
+        ChangeLog.objects.filter(package__in=pks),
+        Release.objects.filter(package__in=pks),
+        PackageURI.objects.filter(package__in=pks),
+        ReadTheDocsPackageSlug.objects.filter(package__in=pks),
+        PyPIMirrorPage.objects.filter(package__in=pks),
+        PyPIServerSigPage.objects.filter(package__in=pks),
+        List.packages.through.objects.filter(package__in=pks),
+        Package.objects.filter(pk__in=pks),
+    ]
+
+    counts = {}
+
+    with transaction.commit_on_success():
+        for queryset in deletes:
+            counts[queryset.model._meta.db_table] = raw_delete(queryset)
+
+        Event.objects.bulk_create([Event(package=package.name, action=Event.ACTIONS.package_delete) for package in packages])
+
+    logger.info("[DELETE] %s packages, %s" % (len(packages), ", ".join(["%s %s" % (count, table) for table, count in sorted(counts.items()) if count])))
+
+    try:
+        index = connections["default"].get_unified_index().get_index(Package)
+    except NotHandled:
+        pass
+    else:
+        for package in packages:
+            index.enqueue_delete(package)
+
+    from crate.pypi.tasks import refresh_pypi_package_index_cache
+    from crate.web.packages.tasks import refresh_package_index_cache
+
+    refresh_package_index_cache.delay()
+
+    if counts.get(PyPIMirrorPage._meta.db_table):
+        refresh_pypi_package_index_cache.delay()
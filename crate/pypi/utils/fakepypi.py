@@ -0,0 +1,155 @@
+"""
+A small in-process stand in for PyPI that serves both the XML-RPC API and
+the per package JSON documents out of a dict, for exercising the sync
+against a local upstream by pointing PYPI_INDEX_URL at it.
+
+Usage::
+
+    packages = {
+        "Django": {
+            "1.4.2": {
+                "data": {"name": "Django", "version": "1.4.2", ...},
+                "urls": [{"filename": "Django-1.4.2.tar.gz", ...}],
+            },
+        },
+    }
+
+    with FakePyPI(packages) as pypi:
+        settings.PYPI_INDEX_URL = pypi.url
+        PyPIPackage("Django").process()
+
+It can also be run on its own, serving a JSON file in the same format::
+
+    python -m crate.pypi.utils.fakepypi packages.json 8765
+"""
+import BaseHTTPServer
+import datetime
+import json
+import SimpleXMLRPCServer
+import SocketServer
+import sys
+import threading
+import urllib
+
+
+class FakePyPIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, packages):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakePyPIHandler)
+
+        self.packages = packages
+
+        self.dispatcher = SimpleXMLRPCServer.SimpleXMLRPCDispatcher(allow_none=True, encoding=None)
+        self.dispatcher.register_introspection_functions()
+        self.dispatcher.register_multicall_functions()
+
+        for name in ["list_packages", "package_releases", "release_data", "release_urls"]:
+            self.dispatcher.register_function(getattr(self, name), name)
+
+    def list_packages(self):
+        return sorted(self.packages.keys())
+
+    def package_releases(self, name, show_hidden=False):
+        return sorted(self.packages.get(name, {}).keys(), reverse=True)
+
+    def release_data(self, name, version):
+        return self.packages.get(name, {}).get(version, {}).get("data", {})
+
+    def release_urls(self, name, version):
+        return self.packages.get(name, {}).get(version, {}).get("urls", [])
+
+    def json_urls(self, name, version):
+        urls = []
+        for url_data in self.release_urls(name, version):
+            url_data = dict(url_data)
+            if isinstance(url_data.get("upload_time"), datetime.datetime):
+                url_data["upload_time"] = url_data["upload_time"].strftime("%Y-%m-%dT%H:%M:%S")
+            urls.append(url_data)
+        return urls
+
+    def json_document(self, name, version=None):
+        releases = self.packages.get(name)
+
+        if not releases or (version is not None and version not in releases):
+            return None
+
+        if version is None:
+            version = sorted(releases.keys())[-1]
+            document = {"releases": dict([(v, self.json_urls(name, v)) for v in releases])}
+        else:
+            document = {}
+
+        document.update({
+            "info": self.release_data(name, version),
+            "urls": self.json_urls(name, version),
+        })
+
+        return document
+
+
+class FakePyPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.respond(200, "text/xml", self.server.dispatcher._marshaled_dispatch(body))
+
+    def do_GET(self):
+        path = [urllib.unquote(x).decode("utf-8") for x in self.path.split("?", 1)[0].strip("/").split("/")]
+
+        # /pypi/<name>/json or /pypi/<name>/<version>/json
+        if len(path) in [3, 4] and path[-1] == "json":
+            document = self.server.json_document(*path[1:-1])
+            if document is not None:
+                return self.respond(200, "application/json", json.dumps(document))
+
+        self.respond(404, "text/plain", "Not Found")
+
+    def respond(self, status, content_type, content):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakePyPI(object):
+
+    def __init__(self, packages, host="127.0.0.1", port=0):
+        self.server = FakePyPIServer((host, port), packages)
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%s/pypi" % self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as fp:
+        packages = json.load(fp)
+
+    server = FakePyPIServer(("127.0.0.1", int(sys.argv[2]) if len(sys.argv) > 2 else 8765), packages)
+    print "Serving fake PyPI on http://%s:%s/pypi" % server.server_address
+    server.serve_forever()
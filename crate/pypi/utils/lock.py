@@ -1,9 +1,9 @@
 import time
 
-import redis
-
 from django.conf import settings
 
+from crate.pypi import client
+
 
 class LockTimeout(BaseException):
     pass
@@ -32,28 +32,42 @@ class Lock(object):
         self.timeout = timeout
         self.expires = expires
 
-        self.datastore = redis.StrictRedis(**dict([(x.lower(), y) for x, y in settings.REDIS[settings.LOCK_DATASTORE].items()]))
+        self.datastore = client.get_datastore(settings.LOCK_DATASTORE)
 
-    def __enter__(self):
+    def acquire(self, blocking=True):
+        """
+        Returns whether the lock was gained. When not ``blocking`` it only
+        tries once instead of waiting up to ``timeout`` seconds.
+        """
         timeout = self.timeout
         while timeout >= 0:
             expires = time.time() + self.expires + 1
 
             if self.datastore.setnx(self.key, expires):
                 # We gained the lock; enter critical section
-                return
+                return True
 
             current_value = self.datastore.get(self.key)
 
             # We found an expired lock and nobody raced us to replacing it
             if current_value and float(current_value) < time.time() and \
                 self.datastore.getset(self.key, expires) == current_value:
-                    return
+                    return True
+
+            if not blocking:
+                return False
 
             timeout -= 1
             time.sleep(1)
 
-        raise LockTimeout("Timeout whilst waiting for lock")
+        return False
 
-    def __exit__(self, exc_type, exc_value, traceback):
+    def release(self):
         self.datastore.delete(self.key)
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeout("Timeout whilst waiting for lock")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
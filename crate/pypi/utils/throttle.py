@@ -0,0 +1,111 @@
+import time
+import uuid
+
+from django.conf import settings
+
+from crate.pypi import client
+
+
+class Semaphore(object):
+    def __init__(self, key, limit, expires=60 * 60):
+        """
+        Counting semaphore shared between processes using a Redis sorted set
+        of holders scored by when they acquired it.
+
+        Usage::
+
+            semaphore = Semaphore("downloads", 4)
+            token = semaphore.acquire(timeout=30)
+            if token is not None:
+                try:
+                    print "One of at most 4"
+                finally:
+                    semaphore.release(token)
+
+        :param  limit       The most holders allowed at once.
+        :param  expires     Holders older than ``expires`` seconds are
+                            considered crashed and their slot is reclaimed.
+        """
+
+        self.key = "%s-semaphore" % key
+        self.limit = limit
+        self.expires = expires
+
+        self.datastore = client.get_datastore(settings.LOCK_DATASTORE)
+
+    def acquire(self, timeout=0):
+        """
+        Returns a token to pass to release once a slot is free, waiting up to
+        ``timeout`` seconds for one (None waits as long as it takes), else
+        None. A ``timeout`` of 0 means we never wait.
+        """
+        waited = 0
+
+        while True:
+            token = uuid.uuid4().hex
+            now = time.time()
+
+            pipe = self.datastore.pipeline()
+            pipe.zremrangebyscore(self.key, "-inf", now - self.expires)
+            pipe.zadd(self.key, now, token)
+            pipe.zrank(self.key, token)
+            rank = pipe.execute()[-1]
+
+            if rank is not None and rank < self.limit:
+                return token
+
+            self.datastore.zrem(self.key, token)
+
+            if timeout is not None and waited >= timeout:
+                return None
+
+            waited += 1
+            time.sleep(1)
+
+    def release(self, token):
+        self.datastore.zrem(self.key, token)
+
+
+class BandwidthBudget(object):
+    def __init__(self, key, rate):
+        """
+        Limits the combined throughput of every process sharing ``key`` to
+        ``rate`` bytes per second, counted in one second windows. A rate of
+        0 or None disables the limit.
+
+        Usage::
+
+            budget = BandwidthBudget("downloads", 1024 * 1024)
+            for chunk in resp.iter_content(8192):
+                budget.consume(len(chunk))
+        """
+
+        self.key = "%s-bandwidth" % key
+        self.rate = rate
+
+        self.datastore = client.get_datastore(settings.LOCK_DATASTORE)
+
+    def consume(self, size):
+        """
+        Charges ``size`` bytes against the budget, sleeping until the next
+        window for as long as the current one is used up.
+        """
+        if not self.rate:
+            return
+
+        while True:
+            window = int(time.time())
+            key = "%s:%s" % (self.key, window)
+
+            pipe = self.datastore.pipeline()
+            pipe.incrby(key, size)
+            pipe.expire(key, 10)
+            used = pipe.execute()[0]
+
+            # A single charge larger than the whole budget gets a window to itself
+            if used <= self.rate or used == size:
+                return
+
+            # This window is spent, take the charge back out and try the next one
+            self.datastore.decrby(key, size)
+            time.sleep(max(window + 1 - time.time(), 0))
@@ -0,0 +1,42 @@
+import threading
+
+from crate.web.packages.models import TroveClassifier
+
+_lock = threading.Lock()
+_troves = None
+
+
+def refresh():
+    """
+        Reloads the worker local map of trove -> TroveClassifier id.
+    """
+    global _troves
+
+    troves = dict(TroveClassifier.objects.values_list("trove", "pk"))
+
+    with _lock:
+        _troves = troves
+
+    return troves
+
+
+def get_ids(classifiers):
+    """
+        Returns a dict of trove -> TroveClassifier id for ``classifiers``,
+        creating any classifier that does not exist yet. The map is loaded once
+        per worker and only reloaded when a classifier is missing from it.
+    """
+    troves = _troves if _troves is not None else refresh()
+
+    if any([classifier not in troves for classifier in classifiers]):
+        troves = dict(refresh())
+
+        for classifier in set([x for x in classifiers if x not in troves]):
+            trove = TroveClassifier(trove=classifier)
+            trove.full_clean()
+            trove.save(force_insert=True)
+
+            # Not added to the shared map, the transaction creating it may still roll back
+            troves[classifier] = trove.pk
+
+    return dict([(classifier, troves[classifier]) for classifier in classifiers])
@@ -0,0 +1,41 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from crate.web.packages.models import Release, get_version_key
+
+
+class Command(BaseCommand):
+
+    help = "Populates Release.version_key for releases that do not have one yet."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+                    help="Number of releases to update per transaction."),
+        make_option("--all", action="store_true", dest="all", default=False,
+                    help="Recompute the key of every release, not just the missing ones."),
+    )
+
+    def handle(self, *args, **options):
+        releases = Release.objects.all()
+        if not options["all"]:
+            releases = releases.filter(version_key="")
+
+        last_pk = 0
+        total = 0
+
+        while True:
+            batch = list(releases.filter(pk__gt=last_pk).order_by("pk").values_list("pk", "version", "created")[:options["batch_size"]])
+
+            if not batch:
+                break
+
+            with transaction.commit_on_success():
+                for pk, version, created in batch:
+                    Release.objects.filter(pk=pk).update(version_key=get_version_key(version, created))
+
+            last_pk = batch[-1][0]
+            total += len(batch)
+
+            self.stdout.write("Updated %s releases\n" % total)
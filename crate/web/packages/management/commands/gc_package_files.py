@@ -0,0 +1,72 @@
+import datetime
+import posixpath
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from crate.web.packages.models import ReleaseFile, release_file_blob_root, release_file_references
+
+
+class Command(BaseCommand):
+
+    help = "Deletes stored content addressed package files that no ReleaseFile references any more."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+                    help="Only list the orphaned files, do not delete them."),
+        make_option("--min-age", type="int", dest="min_age", default=24,
+                    help="Leave files modified in the last MIN_AGE hours alone, they may be mid upload."),
+    )
+
+    def handle(self, *args, **options):
+        storage = ReleaseFile._meta.get_field("file").storage
+        root = release_file_blob_root()
+
+        if not storage.exists(root):
+            self.stdout.write("There are no content addressed files stored under %s\n" % root)
+            return
+
+        references = release_file_references()
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=options["min_age"])
+
+        found = 0
+        orphaned = 0
+
+        # Only the content addressed blobs, anything else in the storage is not ours to collect
+        for name in self.walk(storage, root):
+            found += 1
+
+            if name in references:
+                continue
+
+            try:
+                if storage.modified_time(name) > cutoff:
+                    continue
+            except NotImplementedError:
+                pass
+
+            # The file may have been reused by a new upload since we loaded the references
+            if ReleaseFile.objects.filter(file=name).exists():
+                continue
+
+            orphaned += 1
+
+            if options["dry_run"]:
+                self.stdout.write("Would delete %s\n" % name)
+            else:
+                storage.delete(name)
+                self.stdout.write("Deleted %s\n" % name)
+
+        self.stdout.write("%s of %s stored files were orphaned\n" % (orphaned, found))
+
+    def walk(self, storage, path):
+        directories, files = storage.listdir(path)
+
+        for name in files:
+            yield posixpath.join(path, name)
+
+        for directory in directories:
+            for name in self.walk(storage, posixpath.join(path, directory)):
+                yield name
@@ -1,17 +1,20 @@
+import contextlib
+import copy
 import datetime
+import hashlib
 import os
 import posixpath
 import re
-import urlparse
+import threading
+import urllib
 import uuid
 import cStringIO
 import sys
 
 import bleach
 import jinja2
-import lxml.html
 
-from docutils.core import publish_string, publish_parts
+from docutils.core import publish_parts
 from docutils.utils import SystemMessage
 
 
@@ -19,7 +22,7 @@ from django.conf import settings
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Count, Sum
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils.encoding import smart_str, force_unicode
@@ -49,6 +52,12 @@ ALLOWED_ATTRIBUTES.update({
     "span": ["class"],
 })
 
+# Per thread switch for the version_ordering receiver, see suspended_version_ordering
+_version_ordering = threading.local()
+
+# Per thread queue of link extractions held back by deferred_link_extraction
+_link_extraction = threading.local()
+
 # Get the Storage Engine for Packages
 if getattr(settings, "PACKAGE_FILE_STORAGE", None):
     mod_name, engine_name = settings.PACKAGE_FILE_STORAGE.rsplit(".", 1)
@@ -58,26 +67,116 @@ else:
     package_storage = None
 
 
+# Ranks for the strings that can show up in NormalizedVersion.parts, in the
+# same order comparing the strings themselves would put them in.
+_version_key_strings = {"a": "1", "b": "2", "c": "3", "dev": "4", "f": "5", "post": "6", "rc": "7"}
+
+
+def get_version_key(version, created):
+    """
+    Returns a string that sorts releases the same way ``version_ordering``
+    does when compared as plain text, so the database can order by it.
+
+    Rational versions encode each part of ``NormalizedVersion.parts``, ints as
+    fixed width numbers and strings by rank, with a terminator that sorts
+    below any element so a shorter part sorts first just like tuples do.
+    Irrational versions fall back to their creation date and sort before any
+    rational version. Only digits are used, so database collations can't
+    change the order.
+    """
+    parts = verlib.parse_version(version)
+
+    if parts is not None:
+        key = _encode_version_parts(parts)
+        if key is not None and len(key) <= 255:
+            return key
+
+    return "0" + created.strftime("%Y%m%d%H%M%S%f")
+
+
+def _encode_version_parts(parts):
+    key = ["1"]
+
+    for part in parts:
+        for item in part:
+            if isinstance(item, basestring) and item in _version_key_strings:
+                key.append("1" + _version_key_strings[item])
+            elif isinstance(item, (int, long)) and item < 10 ** 8:
+                key.append("2%08d" % item)
+            else:
+                return None
+        key.append("0")
+
+    return "".join(key)
+
+
+def release_file_blob_root():
+    """
+    The directory content addressed files are stored under. It is kept
+    apart from the ``<base>/a/b/c/d/<sha256>/<filename>`` layout older
+    files still use, whose directories would otherwise share a blob's name.
+    """
+    return posixpath.join(getattr(settings, "PACKAGE_FILE_STORAGE_BASE_DIR", None) or "", "sha256")
+
+
 def release_file_upload_to(instance, filename):
+    """
+    Files with a sha256 digest are stored by content alone, under
+    ``<base>/sha256/a/b/c/d/<sha256>``, so every ReleaseFile with the same
+    bytes shares a single stored blob whatever it is called. Anything else
+    falls back to a random directory named after the file.
+    """
     dsplit = instance.digest.split("$")
-    if len(dsplit) == 2:
+    if len(dsplit) == 2 and dsplit[0] == "sha256":
         directory = dsplit[1]
+        filename = None
+        path_items = [release_file_blob_root()]
     else:
         directory = str(uuid.uuid4()).replace("-", "")
 
-    if getattr(settings, "PACKAGE_FILE_STORAGE_BASE_DIR", None):
-        path_items = [settings.PACKAGE_FILE_STORAGE_BASE_DIR]
-    else:
-        path_items = []
+        if getattr(settings, "PACKAGE_FILE_STORAGE_BASE_DIR", None):
+            path_items = [settings.PACKAGE_FILE_STORAGE_BASE_DIR]
+        else:
+            path_items = []
 
     for char in directory[:4]:
         path_items.append(char)
 
-    path_items += [directory, filename]
+    path_items.append(directory)
+
+    if filename is not None:
+        path_items.append(filename)
 
     return posixpath.join(*path_items)
 
 
+def get_content_disposition(filename):
+    """
+    Returns an attachment Content-Disposition header value for ``filename``
+    with the name quoted, and an RFC 5987 ``filename*`` for names that
+    are not plain ASCII.
+    """
+    filename = "".join([c for c in force_unicode(filename) if c >= u" "])
+
+    quoted = filename.encode("ascii", "replace").replace("\\", "\\\\").replace('"', '\\"')
+    value = 'attachment; filename="%s"' % quoted
+
+    if any([ord(c) > 127 for c in filename]):
+        value += "; filename*=UTF-8''%s" % urllib.quote(filename.encode("utf-8"), safe="")
+
+    return value
+
+
+def release_file_references():
+    """
+    Returns a dict mapping every stored package file name to the number of
+    ReleaseFiles (hidden ones included) that reference it. Stored files that
+    are missing from it are orphans.
+    """
+    references = ReleaseFile.objects.exclude(file="").values("file").annotate(references=Count("pk"))
+    return dict([(x["file"], x["references"]) for x in references.order_by()])
+
+
 # @@@ These are by Nature Hierarchical. Would we benefit from a tree structure?
 class TroveClassifier(models.Model):
     trove = models.CharField(max_length=350, unique=True)
@@ -120,7 +219,7 @@ class Package(TimeStampedModel):
     @property
     def latest(self):
         if not hasattr(self, "_latest_release"):
-            releases = self.releases.filter(hidden=False).order_by("-order")[:1]
+            releases = self.releases.filter(hidden=False).order_by("-version_key")[:1]
             if releases:
                 self._latest_release = releases[0]
             else:
@@ -167,6 +266,7 @@ class Release(models.Model, ReleaseEvaluator):
     show_install_command = models.BooleanField(default=True)
 
     order = models.IntegerField(default=0, db_index=True)
+    version_key = models.CharField(max_length=255, blank=True, db_index=True)
 
     platform = models.TextField(blank=True)
 
@@ -189,6 +289,12 @@ class Release(models.Model, ReleaseEvaluator):
 
     classifiers = models.ManyToManyField(TroveClassifier, related_name="releases", blank=True)
 
+    # Hash of the data this release was last synced from, see crate.pypi.processor
+    fingerprint = models.CharField(max_length=64, blank=True)
+
+    # Hash of the description the package links were last extracted from
+    description_hash = models.CharField(max_length=64, blank=True)
+
     class Meta:
         unique_together = ("package", "version")
 
@@ -196,29 +302,9 @@ class Release(models.Model, ReleaseEvaluator):
         return u"%(package)s %(version)s" % {"package": self.package.name, "version": self.version}
 
     def save(self, *args, **kwargs):
-        # Update the Project's URIs
-        docutils_settings = getattr(settings, "RESTRUCTUREDTEXT_FILTER_SETTINGS", {})
-
-        docutils_settings.update({"warning_stream": os.devnull})
-
-        try:
-            html_string = publish_string(source=smart_str(self.description), writer_name="html4css1", settings_overrides=docutils_settings)
-            if html_string.strip():
-                html = lxml.html.fromstring(html_string)
-
-                for link in html.xpath("//a/@href"):
-                    if len(link) > 400:
-                        # @@@ ugly as sin, but fixes shit for now
-                        continue
-
-                    try:
-                        if any(urlparse.urlparse(link)[:5]):
-                            PackageURI.objects.get_or_create(package=self.package, uri=link)
-                    except ValueError:
-                        pass
-        except Exception:
-            # @@@ We Swallow Exceptions here, but it's the best way that I can think of atm.
-            pass
+        # Recomputed on every save, irrational versions sort by created which
+        # is only filled in with the upload time after the first save
+        self.version_key = get_version_key(self.version, self.created)
 
         super(Release, self).save(*args, **kwargs)
 
@@ -232,6 +318,17 @@ class Release(models.Model, ReleaseEvaluator):
         if _current_show_install_command != self.show_install_command:
             super(Release, self).save(*args, **kwargs)
 
+        # Update the Project's URIs in the background, but only if the description changed
+        if self.description:
+            description_hash = hashlib.sha256(smart_str(self.description)).hexdigest()
+            if description_hash != self.description_hash:
+                pending = getattr(_link_extraction, "pending", None)
+                if pending is not None:
+                    pending.append((self.pk, description_hash))
+                else:
+                    from crate.web.packages.tasks import extract_package_links
+                    extract_package_links.delay(self.pk, description_hash)
+
     def get_absolute_url(self):
         return reverse("package_detail", kwargs={"package": self.package.name, "version": self.version})
 
@@ -381,6 +478,35 @@ class ReleaseFile(models.Model):
     def get_absolute_url(self):
         return self.file.url
 
+    def get_simple_url(self):
+        # The simple package page links here, so reverse from its own urlconf
+        url = reverse("simple_file_redirect", kwargs={"filename": self.filename})
+
+        if "$" in self.digest:
+            url += "#%s" % "=".join(self.digest.split("$", 1))
+
+        return url
+
+    def save_content(self, content):
+        """
+        Points this file at ``content``, uploading it only if a file with the
+        same name, and so with content addressed names the same bytes, is not
+        already stored. Does not save the ReleaseFile itself.
+        """
+        name = self._meta.get_field("file").generate_filename(self, self.filename)
+        storage = self.file.storage
+
+        if not storage.exists(name):
+            if isinstance(getattr(storage, "headers", None), dict):
+                # Content addressed names carry no file name, so have backends
+                # that store headers with the file (S3) send it as an attachment
+                storage = copy.copy(storage)
+                storage.headers = dict(storage.headers, **{"Content-Disposition": get_content_disposition(self.filename)})
+
+            name = storage.save(name, content)
+
+        self.file = name
+
     def get_python_version_display(self):
         if self.python_version.lower() == "source":
             return ""
@@ -487,28 +613,75 @@ class ReadTheDocsPackageSlug(models.Model):
         return u"%s" % self.slug
 
 
-@receiver(post_save, sender=Release)
-def version_ordering(sender, **kwargs):
-    instance = kwargs.get("instance")
-    if instance is not None:
-        releases = Release.objects.filter(package__pk=instance.package.pk)
+@contextlib.contextmanager
+def suspended_version_ordering():
+    """
+    Suspends the ``version_ordering`` receiver in this thread. Meant for bulk
+    ingest which saves many releases of one package and then calls
+    ``update_version_ordering`` once at the end.
+    """
+    _version_ordering.suspended = getattr(_version_ordering, "suspended", 0) + 1
+    try:
+        yield
+    finally:
+        _version_ordering.suspended -= 1
+
+
+@contextlib.contextmanager
+def deferred_link_extraction():
+    """
+    Holds back the ``extract_package_links`` tasks that saving releases in
+    this thread queues until the block exits without an error. Wrapped
+    around a transaction it makes sure the tasks only run once the releases
+    they read are committed.
+    """
+    if getattr(_link_extraction, "pending", None) is not None:
+        # The outermost block queues them
+        yield
+        return
+
+    _link_extraction.pending = []
+    try:
+        yield
+        pending = _link_extraction.pending
+    finally:
+        _link_extraction.pending = None
+
+    from crate.web.packages.tasks import extract_package_links
+
+    for release_pk, description_hash in pending:
+        extract_package_links.delay(release_pk, description_hash)
+
+
+def update_version_ordering(package):
+    releases = Release.objects.filter(package__pk=package.pk).only("pk", "version", "created", "order")
+
+    versions = []
+    dated = []
+
+    for release in releases:
+        parts = verlib.parse_version(release.version)
+        if parts is not None:
+            versions.append((parts, release))
+        else:
+            dated.append(release)
 
-        versions = []
-        dated = []
+    versions.sort(key=lambda x: x[0])
+    dated.sort(key=lambda x: x.created)
+
+    for i, release in enumerate(dated + [release for _, release in versions]):
+        if release.order != i:
+            Release.objects.filter(pk=release.pk).update(order=i)
 
-        for release in releases:
-            normalized = verlib.suggest_normalized_version(release.version)
-            if normalized is not None:
-                versions.append(release)
-            else:
-                dated.append(release)
 
-        versions.sort(key=lambda x: verlib.NormalizedVersion(verlib.suggest_normalized_version(x.version)))
-        dated.sort(key=lambda x: x.created)
+@receiver(post_save, sender=Release)
+def version_ordering(sender, **kwargs):
+    instance = kwargs.get("instance")
 
-        for i, release in enumerate(dated + versions):
-            if release.order != i:
-                Release.objects.filter(pk=release.pk).update(order=i)
+    # The ordering only depends on which versions exist, so only new releases can change it
+    if instance is not None and kwargs.get("created", False):
+        if not getattr(_version_ordering, "suspended", 0):
+            update_version_ordering(instance.package)
 
 
 @receiver(post_save, sender=Package)
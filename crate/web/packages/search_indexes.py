@@ -93,7 +93,7 @@ class PackageIndex(PackageCelerySearchIndex, indexes.Indexable):
             data["python_versions"] = python_versions
 
         # Pack in all the versions in decending order.
-        releases = obj.releases.all().order_by("-order")
+        releases = obj.releases.all().order_by("-version_key")
         data["versions"] = [release.version for release in releases if release.version]
         data["release_count"] = releases.count()
 
@@ -7,4 +7,5 @@ handler404 = "crate.web.packages.simple.views.not_found"
 urlpatterns = patterns("",
     url(r"^$", PackageIndex.as_view(), name="simple_package_index"),
     url(r"^(?P<slug>[^/]+)/(?:(?P<version>[^/]+)/)?$", PackageDetail.as_view(), name="simple_package_detail"),
+    url(r"^packages/(?:.+/)?(?P<filename>[^/]+)$", "crate.pypi.simple.views.file_redirect", name="simple_file_redirect"),
 )
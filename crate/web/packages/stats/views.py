@@ -12,7 +12,7 @@ from crate.web.packages.models import Package, Release, DownloadDelta
 
 
 def fetch_stats(package):
-    releases = list(Release.objects.filter(package=package).only("version", "order").order_by("order"))
+    releases = list(Release.objects.filter(package=package).only("version", "version_key").order_by("version_key"))
     specific_releases = set([x.version for x in releases[-8:]])
 
     deltas = list(DownloadDelta.objects.filter(file__release__in=releases).only("date", "delta", "file__release__version").order_by("date").select_related("file", "file__release"))
@@ -1,9 +1,81 @@
+import hashlib
+import logging
+import os
+import urlparse
+
+import lxml.html
+
 from celery.task import task
+from docutils.core import publish_string
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils.encoding import smart_str
 
+from crate.web.packages.models import Release, PackageURI
 from crate.web.packages.simple.views import PackageIndex
 
+logger = logging.getLogger(__name__)
+
+
+def get_description_links(description):
+    docutils_settings = dict(getattr(settings, "RESTRUCTUREDTEXT_FILTER_SETTINGS", {}))
+    docutils_settings.update({"warning_stream": os.devnull})
+
+    links = set()
+
+    try:
+        html_string = publish_string(source=smart_str(description), writer_name="html4css1", settings_overrides=docutils_settings)
+        if html_string.strip():
+            html = lxml.html.fromstring(html_string)
+
+            for link in html.xpath("//a/@href"):
+                if len(link) > 400:
+                    # @@@ ugly as sin, but fixes shit for now
+                    continue
+
+                try:
+                    if any(urlparse.urlparse(link)[:5]):
+                        links.add(link)
+                except ValueError:
+                    pass
+    except Exception:
+        # @@@ We Swallow Exceptions here, but it's the best way that I can think of atm.
+        pass
+
+    return links
+
 
 @task
 def refresh_package_index_cache():
     pi = PackageIndex()
     pi.get_queryset(force_uncached=True)
+
+
+@task(max_retries=5, default_retry_delay=30)
+def extract_package_links(release_pk, description_hash):
+    try:
+        release = Release.objects.select_related("package").get(pk=release_pk)
+    except Release.DoesNotExist as exc:
+        # The transaction that saved this release might not have committed yet
+        extract_package_links.retry(exc=exc)
+
+    if release.description_hash == description_hash:
+        return
+
+    if hashlib.sha256(smart_str(release.description)).hexdigest() != description_hash:
+        # The description has changed again since, a newer task handles it
+        return
+
+    links = get_description_links(release.description)
+    existing = set(PackageURI.objects.filter(package=release.package, uri__in=list(links)).values_list("uri", flat=True))
+
+    try:
+        with transaction.commit_on_success():
+            PackageURI.objects.bulk_create([PackageURI(package=release.package, uri=link) for link in links - existing])
+    except IntegrityError:
+        # Another release of this package added some of the same links meanwhile
+        for link in links - existing:
+            PackageURI.objects.get_or_create(package=release.package, uri=link)
+
+    Release.objects.filter(pk=release.pk).update(description_hash=description_hash)
@@ -90,7 +90,7 @@ def package_versions(package_name, num=None):
     qs = cache.get(KEY)
 
     if qs is None:
-        qs = Release.objects.filter(package__name=package_name).select_related("package").order_by("-order")
+        qs = Release.objects.filter(package__name=package_name).select_related("package").order_by("-version_key")
         cache.set(KEY, list(qs))
 
     if num is not None:
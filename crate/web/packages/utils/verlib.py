@@ -3,7 +3,10 @@
 discussion at PyCon 2009.
 """
 
+import collections
+import functools
 import re
+import threading
 
 
 class IrrationalVersionError(Exception):
@@ -216,6 +219,40 @@ class NormalizedVersion(object):
         return self.__eq__(other) or self.__gt__(other)
 
 
+# Number of distinct version strings the parse caches hold on to.
+CACHE_SIZE = 10000
+
+
+def _memoize(maxsize):
+    """Bounded least recently used cache for single argument functions."""
+    def decorator(func):
+        cache = collections.OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(s):
+            with lock:
+                if s in cache:
+                    value = cache.pop(s)
+                    cache[s] = value
+                    return value
+
+            value = func(s)
+
+            with lock:
+                cache[s] = value
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+
+            return value
+
+        wrapper.cache_clear = cache.clear
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+
+@_memoize(CACHE_SIZE)
 def suggest_normalized_version(s):
     """Suggest a normalized version close to the given version string.
 
@@ -326,3 +363,35 @@ def suggest_normalized_version(s):
     except IrrationalVersionError:
         pass
     return None
+
+
+@_memoize(CACHE_SIZE)
+def parse_version(s):
+    """Return the `NormalizedVersion.parts` of the suggested normalized
+    version for `s`, or None if no rational version could be suggested.
+
+    The parts are plain tuples, so they make cheap sort keys.
+    """
+    normalized = suggest_normalized_version(s)
+    if normalized is None:
+        return None
+    return NormalizedVersion(normalized).parts
+
+
+def sort_versions(versions, reverse=False):
+    """Sort an iterable of version strings, lowest first.
+
+    Each distinct string is parsed once and the versions are sorted on the
+    resulting tuples. Versions that have no rational suggestion sort before
+    all others, in the order they were given.
+    """
+    versions = list(versions)
+    keys = dict((v, parse_version(v)) for v in set(versions))
+
+    irrational = [v for v in versions if keys[v] is None]
+    rational = sorted([v for v in versions if keys[v] is not None], key=keys.__getitem__)
+
+    result = irrational + rational
+    if reverse:
+        result.reverse()
+    return result
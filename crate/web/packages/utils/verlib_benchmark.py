@@ -0,0 +1,73 @@
+"""
+Micro benchmark for the memoized version parsing in verlib.
+
+Sorts a package's worth of real world version strings the way the release
+ordering used to (normalizing and parsing every version on every sort) and
+with `verlib.sort_versions`, both against a cold and a warm cache::
+
+    python -m crate.web.packages.utils.verlib_benchmark [repeat]
+"""
+import sys
+import timeit
+
+from crate.web.packages.utils import verlib
+
+# Version strings as they appear on PyPI, rational and otherwise.
+VERSIONS = [
+    "0.1", "0.1.1", "0.2", "0.2.0", "0.3dev", "0.3.dev1", "0.3a1", "0.3b2",
+    "0.3c1", "0.3rc1", "0.3", "0.3.post1", "0.3-1", "0.4.0-beta", "0.4.0",
+    "0.9.8", "0.10", "0.10.1", "0.10.1.1", "0.12", "0.14.0", "0.14.1",
+    "0.14.2", "1.0", "1.0.0", "1.0a1", "1.0a2", "1.0b1", "1.0b2", "1.0rc1",
+    "1.0rc2", "1.0.1", "1.0.2", "1.0.3", "1.0-dev", "1.0.dev456", "1.0dev",
+    "1.0.post456", "1.0.post456.dev34", "1.0c1", "1.0pre1", "1.0-r1234",
+    "1.0_final", "1.0-final", "1.1", "1.1.1", "1.1.2", "1.1.3", "1.1.4",
+    "1.2", "1.2.1", "1.2.2", "1.2.3", "1.2.4", "1.2.5", "1.2.6", "1.2.7",
+    "1.3", "1.3.1", "1.3.2", "1.3.3", "1.3.4", "1.3.5", "1.3.6", "1.3.7",
+    "1.4", "1.4a1", "1.4b1", "1.4c1", "1.4c2", "1.4.1", "1.4.2", "1.5a1",
+    "1.7.2", "2.0", "2.0.0b1", "2.0b2", "2.0.1", "2.1", "2.1.0", "2.2",
+    "2.3.1", "2.4", "2.5.2", "2.6", "3.0", "3.0.1", "3.1", "3.1.1",
+    "0.6c11", "0.6c12dev-r88846", "0.6", "0.6.1", "0.6.2", "0.6.3",
+    "0.6.27", "0.6.28", "0.6.29", "0.6.30", "0.6.31", "0.6.32", "0.6.33",
+    "2011.1", "2012.4", "2012c", "2012h", "r123", "dev", "latest",
+    "1.0-SNAPSHOT", "0.1-alpha", "0.1-beta-2", "1.0.0-rc.1", "v1.2",
+]
+
+
+def original_sort(versions):
+    parsed = []
+    irrational = []
+
+    for version in versions:
+        normalized = verlib.suggest_normalized_version.uncached(version)
+        if normalized is not None:
+            parsed.append((verlib.NormalizedVersion(normalized), version))
+        else:
+            irrational.append(version)
+
+    parsed.sort(key=lambda x: x[0])
+    return irrational + [version for _, version in parsed]
+
+
+def cold_sort(versions):
+    verlib.suggest_normalized_version.cache_clear()
+    verlib.parse_version.cache_clear()
+    return verlib.sort_versions(versions)
+
+
+def main(repeat=100):
+    assert original_sort(VERSIONS) == verlib.sort_versions(VERSIONS)
+
+    results = [
+        ("original", lambda: original_sort(VERSIONS)),
+        ("memoized (cold)", lambda: cold_sort(VERSIONS)),
+        ("memoized (warm)", lambda: verlib.sort_versions(VERSIONS)),
+    ]
+
+    print "%d versions, %d sorts each" % (len(VERSIONS), repeat)
+    for name, func in results:
+        elapsed = min(timeit.repeat(func, number=repeat, repeat=3))
+        print "%-16s %8.2f ms/sort" % (name, elapsed / repeat * 1000)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
@@ -25,7 +25,7 @@ class ReleaseDetail(DetailView):
         ctx.update({
             "release_files": [x for x in self.object.files.all() if not x.hidden],
             "version_specific": self.kwargs.get("version", None),
-            "versions": Release.objects.filter(package=self.object.package).select_related("package").order_by("-order"),
+            "versions": Release.objects.filter(package=self.object.package).select_related("package").order_by("-version_key"),
             "history": Event.objects.filter(package=self.object.package.name).order_by("-created"),
         })
         return ctx
@@ -42,7 +42,7 @@ class ReleaseDetail(DetailView):
         if version:
             queryset = queryset.filter(version=version)
         else:
-            queryset = queryset.filter(hidden=False).order_by("-order")[:1]
+            queryset = queryset.filter(hidden=False).order_by("-version_key")[:1]
 
         try:
             obj = queryset.get()